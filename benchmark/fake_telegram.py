@@ -0,0 +1,99 @@
+"""
+Local stand-in of the Telegram Bot API, for the offline benchmark.
+
+Implements the few methods polybot uses (getMe, setWebhook, deleteWebhook, getFile, sendMessage,
+sendPhoto, sendMediaGroup) plus file downloads, and records when every message was sent to which chat.
+Photos are served from a fixed set of JPEG images; each file_id gets a unique trailer appended
+after the JPEG end marker, so every request has distinct bytes (and misses the prediction cache)
+while decoding to the same picture.
+"""
+import argparse
+import itertools
+import threading
+import time
+import zlib
+from flask import Flask, request, jsonify
+from werkzeug.serving import make_server
+
+
+class FakeTelegram:
+
+    def __init__(self, images):
+        self.images = images
+        self.lock = threading.Lock()
+        self.message_ids = itertools.count(1)
+        # chat_id -> list of (method, timestamp)
+        self.deliveries = {}
+        # chat_id -> timestamp of the first getFile, i.e. when polybot started processing the photo
+        self.fetches = {}
+        self.app = self._create_app()
+        self.server = None
+
+    def photo_bytes(self, file_id):
+        image = self.images[zlib.crc32(file_id.encode()) % len(self.images)]
+        return image + f'bench:{file_id}'.encode()
+
+    def _record(self, chat_id, method):
+        with self.lock:
+            self.deliveries.setdefault(str(chat_id), []).append((method, time.time()))
+
+    def _message(self, chat_id):
+        return {'message_id': next(self.message_ids), 'date': int(time.time()), 'chat': {'id': int(chat_id), 'type': 'private'}}
+
+    def _create_app(self):
+        app = Flask(__name__)
+
+        def ok(result):
+            return jsonify({'ok': True, 'result': result})
+
+        @app.route('/bot<token>/<method>', methods=['GET', 'POST'])
+        def api(token, method):
+            # telebot sends parameters in the query string, httpx in the form body
+            params = request.values
+            if method == 'getMe':
+                return ok({'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'})
+            if method in ('setWebhook', 'deleteWebhook'):
+                return ok(True)
+            if method == 'getFile':
+                file_id = params['file_id']
+                # The benchmark's file ids are '<chat_id>-<n>'
+                with self.lock:
+                    self.fetches.setdefault(file_id.split('-')[0], time.time())
+                return ok({'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(self.photo_bytes(file_id)),
+                           'file_path': f'photos/{file_id}.jpg'})
+            if method in ('sendMessage', 'sendPhoto', 'sendMediaGroup'):
+                self._record(params['chat_id'], method)
+                message = self._message(params['chat_id'])
+                return ok([message] if method == 'sendMediaGroup' else message)
+            return jsonify({'ok': False, 'error_code': 404, 'description': f'Not Found: {method}'}), 404
+
+        @app.route('/file/bot<token>/photos/<file_id>.jpg')
+        def download(token, file_id):
+            return self.photo_bytes(file_id), 200, {'Content-Type': 'image/jpeg'}
+
+        return app
+
+    def start(self, host='127.0.0.1', port=8081):
+        self.server = make_server(host, port, self.app, threaded=True)
+        threading.Thread(target=self.server.serve_forever, name='fake-telegram', daemon=True).start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+
+
+def load_images(paths):
+    images = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            images.append(f.read())
+    return images
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('images', nargs='+', help='JPEG images served as the users\' photos')
+    parser.add_argument('--port', type=int, default=8081)
+    args = parser.parse_args()
+
+    FakeTelegram(load_images(args.images)).app.run(host='127.0.0.1', port=args.port, threaded=True)
@@ -0,0 +1,136 @@
+"""
+Inference backend benchmark: throughput and accuracy of every yolo5 inference backend on a fixed
+image set, compared to the FP32 PyTorch baseline.
+
+    python benchmark/inference.py --yolov5-dir ~/yolov5 --batch-size 4 --threads 4
+
+--yolov5-dir is a checkout of ultralytics/yolov5 holding the model files of the backends, built
+the same way as in the yolo5 Dockerfile (export.py to TorchScript and ONNX, then quantize_dynamic).
+Images default to the sample images of the checkout (data/images); use --images with a larger set
+of real photos for meaningful agreement numbers.
+
+For every backend it reports:
+    images/sec   images inferred per second, preprocessing and NMS included
+    precision    share of the backend's boxes that match a baseline box
+    recall       share of the baseline boxes the backend found
+A box matches when it has the same class as a baseline box and an IoU of at least --iou with it.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def box(label):
+    return (label['cx'] - label['width'] / 2, label['cy'] - label['height'] / 2,
+            label['cx'] + label['width'] / 2, label['cy'] + label['height'] / 2)
+
+
+def iou(a, b):
+    ax1, ay1, ax2, ay2 = box(a)
+    bx1, by1, bx2, by2 = box(b)
+    inter = max(0, min(ax2, bx2) - max(ax1, bx1)) * max(0, min(ay2, by2) - max(ay1, by1))
+    union = a['width'] * a['height'] + b['width'] * b['height'] - inter
+    return inter / union if union > 0 else 0
+
+
+def count_matches(labels, baseline, min_iou):
+    """Greedily matches every label to the best unmatched baseline label of the same class"""
+    unmatched = list(baseline)
+    matches = 0
+    for label in sorted(labels, key=lambda l: -l['confidence']):
+        candidates = [(iou(label, other), i) for i, other in enumerate(unmatched) if other['class'] == label['class']]
+        best = max(candidates, default=(0, None))
+        if best[0] >= min_iou:
+            unmatched.pop(best[1])
+            matches += 1
+    return matches
+
+
+def run_backend(detector, images, batch_size, repeat):
+    """:return: the labels of every image and the images/sec over `repeat` passes on the image set"""
+    detector.warmup(batch_size=batch_size)
+    batches = [images[i:i + batch_size] for i in range(0, len(images), batch_size)]
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results = [labels for batch in batches for labels in detector.predict_batch(batch)]
+    elapsed = time.perf_counter() - start
+    return results, len(images) * repeat / elapsed
+
+
+def agreement(results, baseline_results, min_iou):
+    matches = found = expected = 0
+    for labels, baseline in zip(results, baseline_results):
+        matches += count_matches(labels, baseline, min_iou)
+        found += len(labels)
+        expected += len(baseline)
+    return {
+        'precision': matches / found if found else 1.0,
+        'recall': matches / expected if expected else 1.0,
+    }
+
+
+def main(args):
+    # Resolve the yolov5 packages and the model files like the worker does in its Docker image
+    os.chdir(args.yolov5_dir)
+    sys.path[:0] = [os.path.abspath('.'), os.path.join(REPO_DIR, 'yolo5')]
+    import cv2
+    from detector import Detector
+
+    paths = args.images or sorted(glob.glob('data/images/*.jpg'))
+    images = [cv2.imread(path) for path in paths]
+    if not images or any(image is None for image in images):
+        raise SystemExit(f'Could not read the images {paths}')
+    weights = dict(item.split('=', 1) for item in args.weights)
+
+    report = {'images': len(images), 'img_size': args.img_size, 'batch_size': args.batch_size,
+              'threads': args.threads, 'backends': {}}
+    baseline_results = None
+    # The FP32 baseline always runs first, from the original yolov5s.pt
+    for backend in ['baseline'] + args.backends:
+        if backend == 'baseline':
+            detector = Detector(weights=args.baseline_weights, imgsz=args.img_size, backend='pytorch', threads=args.threads)
+        else:
+            detector = Detector(weights=weights.get(backend), imgsz=args.img_size, backend=backend, threads=args.threads)
+        results, throughput = run_backend(detector, images, args.batch_size, args.repeat)
+        if baseline_results is None:
+            baseline_results = results
+        report['backends'][backend] = {'images_per_sec': throughput, **agreement(results, baseline_results, args.iou)}
+
+    baseline_throughput = report['backends']['baseline']['images_per_sec']
+    print(f"{len(images)} images x {args.repeat} passes, batch size {args.batch_size}, {args.threads or 'default'} threads")
+    print(f"{'backend':<10} {'images/sec':>10} {'speedup':>8} {'precision':>10} {'recall':>8}")
+    for backend, row in report['backends'].items():
+        print(f"{backend:<10} {row['images_per_sec']:>10.2f} {row['images_per_sec'] / baseline_throughput:>7.2f}x "
+              f"{row['precision']:>10.3f} {row['recall']:>8.3f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--yolov5-dir', required=True, help='ultralytics/yolov5 checkout with the model files')
+    parser.add_argument('--images', nargs='*', help='images to infer (data/images of the checkout by default)')
+    parser.add_argument('--backends', nargs='*', default=['pytorch', 'onnx', 'int8'], help='backends to compare')
+    parser.add_argument('--weights', action='append', default=[], metavar='BACKEND=PATH',
+                        help='model file of a backend, e.g. int8=yolov5s-int8.onnx (repeatable)')
+    parser.add_argument('--baseline-weights', default='yolov5s.pt', help='model file of the FP32 baseline')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--img-size', type=int, default=640, help='inference image size, like the worker\'s IMG_SIZE')
+    parser.add_argument('--threads', type=int, default=0, help='intra-op threads, 0 keeps the library default')
+    parser.add_argument('--repeat', type=int, default=10, help='passes over the image set')
+    parser.add_argument('--iou', type=float, default=0.5, help='min IoU of two matching boxes')
+    parser.add_argument('--json', help='also write the report to this file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_args())
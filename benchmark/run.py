@@ -0,0 +1,333 @@
+"""
+Offline end-to-end load and latency benchmark.
+
+Runs the full polybot -> SQS -> yolo5 -> MongoDB -> /results loop on a single Linux box, with local
+stand-ins for AWS S3/SQS (moto server), the Telegram Bot API (fake_telegram.py) and MongoDB (a
+local mongod), sends synthetic photo messages to polybot's /loadTest/ route at a fixed rate, and
+reports the throughput and the p50/p95/p99 latency of every stage.
+
+    pip install -r benchmark/requirements.txt
+    python benchmark/run.py --yolov5-dir ~/yolov5 --rate 5 --duration 60 --workers 2
+
+--yolov5-dir is a checkout of ultralytics/yolov5 with yolov5s.pt downloaded into it: the worker
+imports its `models` and `utils` packages, as it does in the yolo5 Docker image.
+Pass --mongo-uri to use an already running MongoDB instead of starting mongod.
+
+Stages, measured per photo:
+    webhook          /loadTest/ request until polybot answered it
+    ingest           request sent until polybot fetched the photo from Telegram
+    upload_enqueue   photo fetched until it was uploaded to S3 (the upload time is part of the S3 key)
+    queue_inference  uploaded until yolo5 stored the prediction summary (SQS wait, download, inference, upload)
+    delivery         summary stored until the result text reached the chat
+    end_to_end       request sent until the result text reached the chat
+"""
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+import requests
+from PIL import Image, ImageDraw
+from pymongo import MongoClient
+from fake_telegram import FakeTelegram, load_images
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUCKET_NAME = 'polybot-bench'
+QUEUE_NAME = 'polybot-bench'
+TELEGRAM_TOKEN = 'bench-token'
+POLYBOT_PORT = 8443
+# Off the fake Telegram API's default port
+POLYBOT_METRICS_PORT = 9090
+STAGES = ('webhook', 'ingest', 'upload_enqueue', 'queue_inference', 'delivery', 'end_to_end')
+
+
+def wait_for_port(port, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(('127.0.0.1', port)) == 0:
+                return
+        time.sleep(0.2)
+    raise RuntimeError(f'Nothing is listening on port {port} after {timeout}s')
+
+
+def wait_for_ready(url, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f'{url} is not ready after {timeout}s')
+
+
+def synthetic_images(count=4, size=(1280, 960), seed=0):
+    """JPEG images of random boxes and ellipses, used when no --images are given"""
+    rng = random.Random(seed)
+    images = []
+    for _ in range(count):
+        img = Image.new('RGB', size, tuple(rng.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(img)
+        for _ in range(12):
+            x, y = rng.randrange(size[0]), rng.randrange(size[1])
+            box = (x, y, x + rng.randrange(50, 400), y + rng.randrange(50, 400))
+            color = tuple(rng.randrange(256) for _ in range(3))
+            (draw.rectangle if rng.random() < 0.5 else draw.ellipse)(box, fill=color)
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=90)
+        images.append(buffer.getvalue())
+    return images
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+class Benchmark:
+
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix='polybot-bench-')
+        self.processes = []
+        self.fake_telegram = None
+        self.mongo_uri = args.mongo_uri
+        self.env = None
+
+    def spawn(self, name, cmd, env=None, cwd=None):
+        log = open(os.path.join(self.workdir, f'{name}.log'), 'w')
+        process = subprocess.Popen(cmd, env=env, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+        self.processes.append(process)
+        return process
+
+    def start_stand_ins(self):
+        args = self.args
+        self.spawn('moto', [sys.executable, '-m', 'moto.server', '-p', str(args.moto_port)])
+        wait_for_port(args.moto_port)
+        moto_url = f'http://127.0.0.1:{args.moto_port}'
+
+        aws = dict(endpoint_url=moto_url, region_name='us-east-1', aws_access_key_id='bench', aws_secret_access_key='bench')
+        boto3.client('s3', **aws).create_bucket(Bucket=BUCKET_NAME)
+        sqs_url = boto3.client('sqs', **aws).create_queue(QueueName=QUEUE_NAME)['QueueUrl']
+
+        if not self.mongo_uri:
+            dbpath = os.path.join(self.workdir, 'mongo')
+            os.makedirs(dbpath)
+            self.spawn('mongod', ['mongod', '--dbpath', dbpath, '--port', str(args.mongo_port), '--bind_ip', '127.0.0.1'])
+            wait_for_port(args.mongo_port)
+            self.mongo_uri = f'mongodb://127.0.0.1:{args.mongo_port}/'
+
+        images = load_images(args.images) if args.images else synthetic_images()
+        self.fake_telegram = FakeTelegram(images)
+        self.fake_telegram.start(port=args.telegram_port)
+
+        self.env = {
+            **os.environ,
+            'AWS_ENDPOINT_URL': moto_url,
+            'AWS_ACCESS_KEY_ID': 'bench',
+            'AWS_SECRET_ACCESS_KEY': 'bench',
+            'AWS_DEFAULT_REGION': 'us-east-1',
+            'SQS_REGION': 'us-east-1',
+            'BUCKET_NAME': BUCKET_NAME,
+            'SQS_URL': sqs_url,
+            'MONGO_URI': self.mongo_uri,
+            'CALLBACK_TOKEN': 'bench',
+        }
+
+    def start_services(self):
+        args = self.args
+        polybot_env = {
+            **self.env,
+            'TELEGRAM_TOKEN': TELEGRAM_TOKEN,
+            'TELEGRAM_APP_URL': f'http://127.0.0.1:{POLYBOT_PORT}',
+            'TELEGRAM_API_URL': f'http://127.0.0.1:{args.telegram_port}',
+            'POLYBOT_SERVER': args.server,
+            'METRICS_PORT': str(POLYBOT_METRICS_PORT),
+        }
+        self.spawn('polybot', [sys.executable, 'app.py'], env=polybot_env, cwd=os.path.join(REPO_DIR, 'polybot'))
+
+        yolo5_env = {
+            **self.env,
+            'POLYBOT_URL': f'http://127.0.0.1:{POLYBOT_PORT}',
+            'PYTHONPATH': os.path.abspath(args.yolov5_dir),
+        }
+        yolo5_env.update(item.split('=', 1) for item in args.worker_env)
+        for i in range(args.workers):
+            # Run from the yolov5 checkout, so data/coco128.yaml and yolov5s.pt resolve like in the Docker image
+            self.spawn(f'yolo5-{i}', [sys.executable, os.path.join(REPO_DIR, 'yolo5', 'app.py')],
+                       env={**yolo5_env, 'METRICS_PORT': str(args.metrics_port + i)}, cwd=args.yolov5_dir)
+
+        wait_for_port(POLYBOT_PORT)
+        for i in range(args.workers):
+            wait_for_ready(f'http://127.0.0.1:{args.metrics_port + i}/readyz', args.startup_timeout)
+
+    def photo_update(self, chat_id):
+        file_id = f'{chat_id}-0'
+        return {
+            'update_id': chat_id,
+            'message': {
+                'message_id': 1,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'photo': [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1280, 'height': 960}],
+            }
+        }
+
+    def send(self, chat_id):
+        sent = time.time()
+        response = requests.post(f'http://127.0.0.1:{POLYBOT_PORT}/loadTest/', json=self.photo_update(chat_id), timeout=30)
+        response.raise_for_status()
+        return chat_id, sent, time.time()
+
+    def wait_for_results(self, chat_ids, timeout):
+        deadline = time.time() + timeout
+        pending = set(str(chat_id) for chat_id in chat_ids)
+        while pending and time.time() < deadline:
+            deliveries = self.fake_telegram.deliveries
+            pending = {chat_id for chat_id in pending
+                       if not any(method == 'sendMessage' for method, _ in deliveries.get(chat_id, []))}
+            time.sleep(0.2)
+        return pending
+
+    def warm_up(self):
+        """Sends a single photo and waits for its result, so model loading is not part of the measurement"""
+        chat_id = 1
+        self.send(chat_id)
+        if self.wait_for_results([chat_id], self.args.startup_timeout):
+            raise RuntimeError(f'The warm-up photo got no result within {self.args.startup_timeout}s, see the logs in {self.workdir}')
+
+    def run_load(self):
+        args = self.args
+        chat_ids = [100000 + i for i in range(int(args.rate * args.duration))]
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            futures = []
+            for i, chat_id in enumerate(chat_ids):
+                # Open loop: requests go out on schedule, however slowly the previous ones are answered
+                time.sleep(max(0, start + i / args.rate - time.time()))
+                futures.append(executor.submit(self.send, chat_id))
+            sends = [future.result() for future in futures]
+
+        pending = self.wait_for_results(chat_ids, args.drain_timeout)
+        return start, sends, pending
+
+    def collect(self, sends, pending):
+        collection = MongoClient(self.mongo_uri)['polybot-info']['prediction_images']
+        documents = {doc['chat_id']: doc for doc in collection.find(
+            {'chat_id': {'$in': [str(chat_id) for chat_id, _, _ in sends]}},
+            {'_id': 0, 'chat_id': 1, 'original_img_path': 1, 'time': 1})}
+
+        samples = {stage: [] for stage in STAGES}
+        completions = []
+        for chat_id, sent, answered in sends:
+            chat_id = str(chat_id)
+            samples['webhook'].append(answered - sent)
+            if chat_id in pending or chat_id not in documents:
+                continue
+
+            fetched = self.fake_telegram.fetches[chat_id]
+            # The S3 key polybot uploads is '<chat_id>_<time_ns>_teleBOT_picture.jpg'
+            uploaded = int(documents[chat_id]['original_img_path'].split('_')[1]) / 1e9
+            stored = documents[chat_id]['time']
+            delivered = max(t for method, t in self.fake_telegram.deliveries[chat_id] if method == 'sendMessage')
+
+            samples['ingest'].append(fetched - sent)
+            samples['upload_enqueue'].append(uploaded - fetched)
+            samples['queue_inference'].append(stored - uploaded)
+            samples['delivery'].append(delivered - stored)
+            samples['end_to_end'].append(delivered - sent)
+            completions.append(delivered)
+        return samples, completions
+
+    def report(self, start, sends, pending, samples, completions):
+        elapsed = (max(completions) - start) if completions else 0
+        report = {
+            'sent': len(sends),
+            'completed': len(completions),
+            'timed_out': len(pending),
+            'throughput': len(completions) / elapsed if elapsed else 0,
+            'stages': {
+                stage: {
+                    'count': len(values),
+                    'p50': percentile(values, 50),
+                    'p95': percentile(values, 95),
+                    'p99': percentile(values, 99),
+                    'mean': sum(values) / len(values),
+                } for stage, values in samples.items() if values
+            },
+        }
+
+        print(f"\nsent {report['sent']}, completed {report['completed']}, timed out {report['timed_out']}, "
+              f"throughput {report['throughput']:.2f} photos/s\n")
+        print(f"{'stage':<16}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'mean ms':>10}")
+        for stage, stats in report['stages'].items():
+            print(f"{stage:<16}{stats['count']:>8}{stats['p50'] * 1000:>10.1f}{stats['p95'] * 1000:>10.1f}"
+                  f"{stats['p99'] * 1000:>10.1f}{stats['mean'] * 1000:>10.1f}")
+
+        if self.args.json:
+            with open(self.args.json, 'w') as f:
+                json.dump(report, f, indent=2)
+        return report
+
+    def stop(self):
+        if self.fake_telegram is not None:
+            self.fake_telegram.stop()
+        for process in reversed(self.processes):
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if self.args.keep_logs:
+            print(f'Logs kept in {self.workdir}')
+        else:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def run(self):
+        try:
+            self.start_stand_ins()
+            self.start_services()
+            self.warm_up()
+            start, sends, pending = self.run_load()
+            samples, completions = self.collect(sends, pending)
+            return self.report(start, sends, pending, samples, completions)
+        finally:
+            self.stop()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--yolov5-dir', required=True, help='ultralytics/yolov5 checkout with yolov5s.pt')
+    parser.add_argument('--rate', type=float, default=2, help='photos sent per second')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load')
+    parser.add_argument('--workers', type=int, default=1, help='number of yolo5 worker processes')
+    parser.add_argument('--worker-env', action='append', default=[], metavar='KEY=VALUE',
+                        help='extra env var of the yolo5 workers, e.g. BATCH_MAX_SIZE=4 (repeatable)')
+    parser.add_argument('--server', choices=('flask', 'asgi'), default='flask', help='polybot serving mode')
+    parser.add_argument('--images', nargs='*', help='JPEG images used as the users\' photos (synthetic by default)')
+    parser.add_argument('--concurrency', type=int, default=64, help='max in-flight /loadTest/ requests')
+    parser.add_argument('--mongo-uri', help='use this MongoDB instead of starting mongod')
+    parser.add_argument('--mongo-port', type=int, default=27018)
+    parser.add_argument('--moto-port', type=int, default=5000)
+    parser.add_argument('--telegram-port', type=int, default=8081)
+    parser.add_argument('--metrics-port', type=int, default=9100, help='admin port of the first worker, the next ones count up')
+    parser.add_argument('--startup-timeout', type=float, default=300, help='seconds to wait for the workers to be ready and for the warm-up result')
+    parser.add_argument('--drain-timeout', type=float, default=120, help='seconds to wait for results after the load')
+    parser.add_argument('--json', help='also write the report to this file')
+    parser.add_argument('--keep-logs', action='store_true', help='keep the services logs')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    Benchmark(parse_args()).run()
@@ -1,13 +1,40 @@
 import json
 import boto3
 import paramiko
+import threading
 import time
 import io  # Added import for in-memory file handling
+from concurrent.futures import ThreadPoolExecutor
 
 # AWS clients
 ec2_client = boto3.client("ec2")
 secrets_client = boto3.client("secretsmanager")
 dynamodb = boto3.client("dynamodb")
+autoscaling_client = boto3.client("autoscaling")
+
+# Values reused across warm invocations: name -> (value, expiry time)
+_cache = {}
+_cache_locks = {}
+_cache_lock = threading.Lock()
+
+def cached(name, ttl, load):
+    """
+    Return the cached value of `name`, calling load() when it is missing or older than `ttl` seconds.
+    A failed load (None) is not cached. Concurrent callers wait for a single load.
+    """
+    with _cache_lock:
+        lock = _cache_locks.setdefault(name, threading.Lock())
+    with lock:
+        entry = _cache.get(name)
+        if entry and entry[1] > time.time():
+            return entry[0]
+        value = load()
+        if value is not None:
+            _cache[name] = (value, time.time() + ttl)
+        return value
+
+def invalidate(name):
+    _cache.pop(name, None)
 
 def get_control_plane_ip(instance_id):
     """Retrieve the Public or Private IP of the Control Plane."""
@@ -24,21 +51,58 @@ def get_control_plane_ip(instance_id):
         print(f"🔴 Error retrieving Control Plane IP: {e}")
         return None
 
-# define the control plane details
-CONTROL_PLANE_INSTANCE_ID = "i-0ec10de6a9c0c195e"  
-CONTROL_PLANE_IP = get_control_plane_ip(CONTROL_PLANE_INSTANCE_ID)
+# define the control plane details, its IP is resolved on first use
+CONTROL_PLANE_INSTANCE_ID = "i-0ec10de6a9c0c195e"
 CONTROL_PLANE_USER = "ubuntu"
+WORKER_USER = "ubuntu"
 
-def check_instance_status(instance_id):
-    """Check the status of an EC2 instance."""
-    try:
-        response = ec2_client.describe_instances(InstanceIds=[instance_id])
-        state = response['Reservations'][0]['Instances'][0]['State']['Name']
-        print(f"Instance {instance_id} is in state: {state}")
-        return state
-    except Exception as e:
-        print(f"Error checking instance status: {e}")
-        return None
+# Cache TTLs in seconds. The join command is cached well within the validity of its token.
+SECRET_TTL = 900
+CONTROL_PLANE_IP_TTL = 300
+JOIN_TOKEN_TTL = 7200
+JOIN_COMMAND_TTL = 3600
+SSH_KEEPALIVE_INTERVAL = 30
+
+# Seconds the pods of a terminating worker have to be evicted, within their own termination grace period
+DRAIN_TIMEOUT = 300
+KUBECTL_TIMEOUT = 60
+
+# Polling of a new worker: the first retry comes after 1s, then the delay doubles up to 10s
+POLL_INITIAL_DELAY = 1
+POLL_MAX_DELAY = 10
+# Seconds a new worker has to be running, reachable over SSH and done with its cloud-init
+NODE_READY_TIMEOUT = 300
+JOIN_TIMEOUT = 120
+SSH_CONNECT_TIMEOUT = 5
+# Lifecycle records handled at once
+MAX_PARALLEL_RECORDS = 10
+
+def wait_until(check, timeout, description):
+    """
+    Call check() with exponential backoff until it returns a truthy value.
+    An exception raised by check() counts as a failed attempt.
+    :return: the value returned by check(), or None after `timeout` seconds
+    """
+    deadline = time.time() + timeout
+    delay = POLL_INITIAL_DELAY
+    while True:
+        try:
+            result = check()
+            if result:
+                return result
+        except Exception as e:
+            print(f"🔸 Still waiting for {description}: {e}")
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            print(f"🔴 Timed out after {timeout}s waiting for {description}")
+            return None
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, POLL_MAX_DELAY)
+
+def describe_instance(instance_id):
+    response = ec2_client.describe_instances(InstanceIds=[instance_id])
+    return response['Reservations'][0]['Instances'][0]
 
 def save_instance_private_ip(instance_id, private_ip):
     """Save private IP to DynamoDB."""
@@ -67,133 +131,324 @@ def get_private_ip_from_db(instance_id):
         print(f"🔴 Error retrieving private IP: {e}")
         return None
 
-def get_private_key():
+def get_control_plane_ip_cached():
+    return cached("control_plane_ip", CONTROL_PLANE_IP_TTL, lambda: get_control_plane_ip(CONTROL_PLANE_INSTANCE_ID))
+
+def get_private_key_data():
     """Retrieve private SSH key from AWS Secrets Manager."""
     try:
         secret_response = secrets_client.get_secret_value(SecretId="ofekh-control-plane-key")
-        private_key_data = secret_response["SecretString"]
         print("✅ Successfully retrieved SSH key")
-        return private_key_data  # Return the key data directly instead of saving to file
+        return secret_response["SecretString"]
     except Exception as e:
         print(f"🔴 Error retrieving SSH key: {e}")
         return None
 
-def generate_kubeadm_token():
-    """Generate a fresh Kubernetes join token on the Control Plane."""
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-    private_key_data = get_private_key()
+def parse_private_key():
+    private_key_data = cached("private_key_data", SECRET_TTL, get_private_key_data)
     if not private_key_data:
         return None
-
     try:
         # Create key directly from string data
-        private_key = paramiko.RSAKey.from_private_key(
-            file_obj=io.StringIO(private_key_data)
-        )
-        ssh.connect(CONTROL_PLANE_IP, username=CONTROL_PLANE_USER, pkey=private_key)
-        stdin, stdout, stderr = ssh.exec_command("sudo kubeadm token create --print-join-command")
-        join_command = stdout.read().decode().strip()
-        ssh.close()
-        return join_command
+        return paramiko.RSAKey.from_private_key(file_obj=io.StringIO(private_key_data))
     except Exception as e:
-        print(f"🔴 Error generating token: {e}")
+        print(f"🔴 Error parsing SSH key: {e}")
         return None
 
-def run_join_command(instance_id, join_command):
-    """SSH into the worker node and run the join command."""
-    # Wait for the worker node to be ready
+def get_private_key():
+    return cached("private_key", SECRET_TTL, parse_private_key)
+
+def connect_ssh(host, username, private_key):
+    """Open an SSH connection, failing fast when the host is not reachable (yet)."""
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     try:
-        time.sleep(180)  # Wait for the worker node to be ready
-        instance_status = check_instance_status(instance_id)
-        if instance_status != "running":
-            print(f"🔴 Instance {instance_id} is not running. Skipping join command.")
-            return None
-    except Exception as e:
-        print(f"🔴 Error checking instance status: {e}")
+        ssh.connect(host, username=username, pkey=private_key, timeout=SSH_CONNECT_TIMEOUT,
+                    banner_timeout=SSH_CONNECT_TIMEOUT, auth_timeout=SSH_CONNECT_TIMEOUT)
+    except Exception:
+        ssh.close()
+        raise
+    return ssh
 
-    # Fetch the worker node Public IP
+def run_command(ssh, command, timeout, on_line=None):
+    """
+    Run a command over SSH and wait for it to finish.
+    :param on_line: called with every line of output as soon as it arrives, to follow a long command
+    :return: (exit status, output with stderr merged), the exit status is None when the command timed out
+    """
+    channel = ssh.get_transport().open_session()
+    channel.set_combine_stderr(True)
+    deadline = time.time() + timeout
+    output = b""
     try:
-        response = ec2_client.describe_instances(InstanceIds=[instance_id])
-        worker_ip = response['Reservations'][0]['Instances'][0]['PublicIpAddress']
+        channel.exec_command(command)
+        while True:
+            if channel.recv_ready():
+                data = channel.recv(65536)
+                if on_line:
+                    # Only the lines completed by this chunk
+                    lines = (output[output.rfind(b"\n") + 1:] + data).split(b"\n")[:-1]
+                    for line in lines:
+                        on_line(line.decode(errors="replace"))
+                output += data
+            elif channel.exit_status_ready():
+                return channel.recv_exit_status(), output.decode(errors="replace").strip()
+            elif time.time() > deadline:
+                print(f"🔴 `{command}` did not finish within {timeout}s")
+                return None, output.decode(errors="replace").strip()
+            else:
+                time.sleep(0.2)
+    finally:
+        channel.close()
+
+# One SSH connection to the control plane, shared by the threads and the warm invocations.
+# Every command runs on its own channel of the connection.
+_control_plane_ssh = None
+_control_plane_lock = threading.Lock()
+
+def get_control_plane_ssh():
+    global _control_plane_ssh
+    with _control_plane_lock:
+        transport = _control_plane_ssh.get_transport() if _control_plane_ssh else None
+        if transport is None or not transport.is_active():
+            control_plane_ip = get_control_plane_ip_cached()
+            if not control_plane_ip:
+                raise RuntimeError("Control Plane IP is unknown")
+            try:
+                _control_plane_ssh = connect_ssh(control_plane_ip, CONTROL_PLANE_USER, get_private_key())
+            except Exception as e:
+                # The control plane may have been restarted with a new public IP, or the key rotated
+                invalidate("control_plane_ip")
+                if isinstance(e, paramiko.AuthenticationException):
+                    invalidate("private_key_data")
+                    invalidate("private_key")
+                raise
+            _control_plane_ssh.get_transport().set_keepalive(SSH_KEEPALIVE_INTERVAL)
+        return _control_plane_ssh
+
+def reset_control_plane_ssh(ssh):
+    global _control_plane_ssh
+    with _control_plane_lock:
+        if _control_plane_ssh is ssh:
+            _control_plane_ssh = None
+    ssh.close()
+
+def run_on_control_plane(command, timeout, on_line=None):
+    """
+    Run a command on the control plane over the shared SSH connection. A connection that died
+    while the Lambda was frozen is reopened, and the command retried once.
+    :return: (exit status, output), like run_command
+    """
+    for attempt in range(2):
+        ssh = get_control_plane_ssh()
+        try:
+            return run_command(ssh, command, timeout, on_line)
+        except (paramiko.SSHException, EOFError, OSError) as e:
+            reset_control_plane_ssh(ssh)
+            if attempt:
+                raise
+            print(f"🔸 Control Plane SSH connection lost, reconnecting: {e}")
+
+def generate_kubeadm_token():
+    """Generate a fresh Kubernetes join token on the Control Plane."""
+    try:
+        status, join_command = run_on_control_plane(
+            f"sudo kubeadm token create --ttl {JOIN_TOKEN_TTL}s --print-join-command", JOIN_TIMEOUT)
+        if status != 0:
+            print(f"🔴 Error generating token: {join_command}")
+            return None
+        return join_command
     except Exception as e:
-        print(f"🔴 Error fetching worker IP: {e}")
+        print(f"🔴 Error generating token: {e}")
         return None
 
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+def get_join_command():
+    return cached("join_command", JOIN_COMMAND_TTL, generate_kubeadm_token)
 
-    private_key_data = get_private_key()
-    if not private_key_data:
-        return None
+def run_join_command(instance_id, join_command, private_key):
+    """
+    Wait until the worker node is running and reachable over SSH, then run the join command on it.
+    :return: True when the node joined the cluster
+    """
+    deadline = time.time() + NODE_READY_TIMEOUT
+
+    def started_instance():
+        instance = describe_instance(instance_id)
+        print(f"Instance {instance_id} is in state: {instance['State']['Name']}")
+        return instance if instance['State']['Name'] != "pending" else None
+
+    instance = wait_until(started_instance, NODE_READY_TIMEOUT, f"instance {instance_id} to leave the pending state")
+    if not instance or instance['State']['Name'] != "running":
+        print(f"🔴 Instance {instance_id} is not running. Skipping join command.")
+        return False
+    worker_ip = instance.get('PublicIpAddress')
+    if not worker_ip:
+        print(f"🔴 Instance {instance_id} has no public IP. Skipping join command.")
+        return False
+
+    ssh = wait_until(lambda: connect_ssh(worker_ip, WORKER_USER, private_key),
+                     deadline - time.time(), f"SSH on worker node {worker_ip}")
+    if not ssh:
+        return False
 
-    # Run the join command on the worker node
     try:
-        # Create key directly from string data
-        private_key = paramiko.RSAKey.from_private_key(
-            file_obj=io.StringIO(private_key_data)
-        )
-        ssh.connect(worker_ip, username="ubuntu", pkey=private_key)
-        stdin, stdout, stderr = ssh.exec_command(f"sudo {join_command}")
-        print(stdout.read().decode())
-        ssh.close()
+        # The join needs the packages installed by the instance user data
+        status, output = run_command(ssh, "cloud-init status --wait", max(deadline - time.time(), 1))
+        if status != 0:
+            print(f"🔸 cloud-init on {worker_ip} did not finish cleanly ({status}), joining anyway: {output}")
+
+        status, output = run_command(ssh, f"sudo {join_command}", JOIN_TIMEOUT)
+        print(output)
+        if status != 0:
+            print(f"🔴 Error joining worker node {worker_ip}: exit status {status}")
+            return False
         print(f"✅ Successfully joined worker node: {worker_ip}")
+        return True
     except Exception as e:
         print(f"🔴 Error joining worker node: {e}")
+        return False
+    finally:
+        ssh.close()
 
-def remove_worker_node(node_name):
-    """Drain and remove a worker node from Kubernetes."""
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+def count_node_pods(node_name):
+    """:return: the number of running pods left on a node, DaemonSet pods aside"""
+    status, output = run_on_control_plane(
+        f"kubectl get pods --all-namespaces --field-selector spec.nodeName={node_name},status.phase=Running "
+        f"--no-headers -o custom-columns=KIND:.metadata.ownerReferences[0].kind", KUBECTL_TIMEOUT)
+    if status != 0:
+        raise RuntimeError(f"could not list the pods of {node_name}: {output}")
+    return len([kind for kind in output.splitlines() if kind.strip() != "DaemonSet"])
 
-    private_key_data = get_private_key()
-    if not private_key_data:
-        return None
+def remove_worker_node(node_name):
+    """
+    Drain and remove a worker node from Kubernetes. The drain evicts the pods of the node, each within
+    its termination grace period, and returns once they are gone, so the yolo5 workers can finish their
+    in-flight jobs. The node is deleted only after its pods have moved.
+    :return: True once the node is removed
+    """
     try:
-        # Create key directly from string data
-        private_key = paramiko.RSAKey.from_private_key(
-            file_obj=io.StringIO(private_key_data)
-        )
-        ssh.connect(CONTROL_PLANE_IP, username=CONTROL_PLANE_USER, pkey=private_key)
-        stdin, stdout, stderr = ssh.exec_command(f"kubectl cordon {node_name}")
-        time.sleep(15) # Wait for pods to be rescheduled
-        stdin, stdout, stderr = ssh.exec_command(f"kubectl drain {node_name} --ignore-daemonsets --delete-emptydir-data --force --timeout=300s --grace-period=0")
-        time.sleep(15) # Wait for pods to be rescheduled
-        stdin, stdout, stderr = ssh.exec_command(f"kubectl delete node {node_name}")
-        ssh.close()
+        status, output = run_on_control_plane(f"kubectl cordon {node_name}", KUBECTL_TIMEOUT)
+        if status != 0:
+            if "NotFound" in output:
+                print(f"🔹 Node {node_name} is not in the cluster")
+                return True
+            print(f"🔴 Error cordoning node {node_name}: {output}")
+            return False
+
+        evicted = []
+        def on_drain_output(line):
+            if line.endswith(" evicted"):
+                evicted.append(line)
+                print(f"🔹 {node_name}: {line} ({len(evicted)} pods evicted)")
+
+        started = time.time()
+        status, output = run_on_control_plane(
+            f"kubectl drain {node_name} --ignore-daemonsets --delete-emptydir-data --force --timeout={DRAIN_TIMEOUT}s",
+            DRAIN_TIMEOUT + KUBECTL_TIMEOUT, on_drain_output)
+        if status != 0:
+            print(f"🔴 Drain of node {node_name} failed ({status}): {output}")
+            return False
+        print(f"🔹 Drained node {node_name} in {time.time() - started:.0f}s, {len(evicted)} pods evicted")
+
+        # The drain waits for the evicted pods to be deleted, make sure nothing was scheduled meanwhile
+        if not wait_until(lambda: count_node_pods(node_name) == 0, KUBECTL_TIMEOUT, f"the pods of {node_name} to move"):
+            return False
+
+        status, output = run_on_control_plane(f"kubectl delete node {node_name}", KUBECTL_TIMEOUT)
+        if status != 0 and "NotFound" not in output:
+            print(f"🔴 Error deleting node {node_name}: {output}")
+            return False
         print(f"✅ Successfully removed worker node: {node_name}")
+        return True
     except Exception as e:
         print(f"🔴 Error removing node {node_name}: {e}")
+        return False
+
+def complete_lifecycle_action(message, result):
+    """Let the Auto Scaling group go on with the launch (CONTINUE) or give up the instance (ABANDON)."""
+    if not message.get("LifecycleActionToken"):
+        return
+    try:
+        autoscaling_client.complete_lifecycle_action(
+            LifecycleHookName=message["LifecycleHookName"],
+            AutoScalingGroupName=message["AutoScalingGroupName"],
+            LifecycleActionToken=message["LifecycleActionToken"],
+            InstanceId=message["EC2InstanceId"],
+            LifecycleActionResult=result
+        )
+        print(f"✅ Completed lifecycle action of {message['EC2InstanceId']}: {result}")
+    except Exception as e:
+        print(f"🔴 Error completing lifecycle action of {message['EC2InstanceId']}: {e}")
+
+def handle_launching(message, join_command, private_key):
+    instance_id = message["EC2InstanceId"]
+    print(f"New worker node detected: {instance_id}")
+    try:
+        private_ip = describe_instance(instance_id)['PrivateIpAddress']
+        save_instance_private_ip(instance_id, private_ip)
+    except Exception as e:
+        print(f"🔴 Error fetching private IP of {instance_id}: {e}")
+
+    joined = bool(join_command) and run_join_command(instance_id, join_command, private_key)
+    if join_command and not joined:
+        # In case its token was deleted on the control plane, the next launch gets a new one
+        invalidate("join_command")
+    # An abandoned launch is terminated and replaced by the Auto Scaling group
+    complete_lifecycle_action(message, "CONTINUE" if joined else "ABANDON")
+    return joined
+
+def handle_terminating(message):
+    instance_id = message["EC2InstanceId"]
+    print(f"Worker node terminating: {instance_id}")
+    removed = False
+    try:
+        private_ip_worker = get_private_ip_from_db(instance_id)
+        node_name = f"ip-{private_ip_worker.replace('.','-')}"
+        print (f"Node name: {node_name}")
+        removed = remove_worker_node(node_name)
+    except Exception as e:
+        print(f"Error removing node: {e}")
+    if removed:
+        complete_lifecycle_action(message, "CONTINUE")
+    else:
+        # The instance keeps running, and its pods serving, until the heartbeat timeout of the hook
+        print(f"🔴 Node of {instance_id} was not removed, leaving its termination to the lifecycle hook timeout")
+    return removed
 
 def lambda_handler(event, context):
     print("Lambda handler started")
     print(f"Event: {json.dumps(event)}")
-    sns_message = json.loads(event['Records'][0]['Sns']['Message'])
-    instance_id = sns_message.get("EC2InstanceId", "Unknown")
-    lifecycle_transition = sns_message.get("LifecycleTransition", "Unknown")
-    print (f"Lifecycle Transition: {lifecycle_transition}")
+    messages = [json.loads(record['Sns']['Message']) for record in event.get('Records', [])]
+    # Skip the autoscaling:TEST_NOTIFICATION sent when the hook is created
+    messages = [message for message in messages if "LifecycleTransition" in message]
+    for message in messages:
+        print (f"Lifecycle Transition: {message['LifecycleTransition']} of {message.get('EC2InstanceId', 'Unknown')}")
+    if not messages:
+        return {"statusCode": 200, "body": "No lifecycle events"}
 
-    if "EC2_INSTANCE_LAUNCHING" in lifecycle_transition:
-        print(f"New worker node detected: {instance_id}")
-        response = ec2_client.describe_instances(InstanceIds=[instance_id])
-        private_id = response['Reservations'][0]['Instances'][0]['PrivateIpAddress']
-        save_instance_private_ip(instance_id, private_id)
-        join_command = generate_kubeadm_token() 
+    private_key = get_private_key()
+    if not private_key:
+        return {"statusCode": 500, "body": "Failed to retrieve SSH key"}
+
+    # One join token for all the nodes launched in this batch, and the following warm invocations
+    join_command = None
+    if any("EC2_INSTANCE_LAUNCHING" in message["LifecycleTransition"] for message in messages):
+        join_command = get_join_command()
         if not join_command:
-            return {"statusCode": 500, "body": "Failed to generate join token"}
+            print("🔴 Failed to generate join token")
+        else:
+            print(f"🔹 Join Command: {join_command}")
 
-        print(f"🔹 Join Command: {join_command}")
-        run_join_command(instance_id, join_command)
+    def handle(message):
+        if "EC2_INSTANCE_LAUNCHING" in message["LifecycleTransition"]:
+            return handle_launching(message, join_command, private_key)
+        elif "EC2_INSTANCE_TERMINATING" in message["LifecycleTransition"]:
+            return handle_terminating(message)
+        return True
 
-    elif "EC2_INSTANCE_TERMINATING" in lifecycle_transition:
-        print(f"Worker node terminating: {instance_id}")
-        try:
-            private_ip_worker = get_private_ip_from_db(instance_id)
-            node_name = f"ip-{private_ip_worker.replace('.','-')}" 
-            print (f"Node name: {node_name}")
-            remove_worker_node(node_name)
-        except Exception as e:
-            print(f"Error removing node: {e}")
+    with ThreadPoolExecutor(max_workers=min(len(messages), MAX_PARALLEL_RECORDS)) as executor:
+        results = list(executor.map(handle, messages))
 
-    return {"statusCode": 200, "body": "Worker node processed successfully"}
\ No newline at end of file
+    if not all(results):
+        return {"statusCode": 500, "body": f"{results.count(False)} of {len(results)} worker nodes failed"}
+    return {"statusCode": 200, "body": "Worker node processed successfully"}
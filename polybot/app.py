@@ -1,8 +1,10 @@
 import flask
-from flask import request
+from flask import request, jsonify
 import os
 from bot import ObjectDetectionBot
-from pymongo import MongoClient
+from predictions import get_prediction_summary, is_trusted_callback
+from history import query_history
+from metrics import start_metrics_server
 from loguru import logger
 
 
@@ -15,6 +17,9 @@ try:
 except KeyError as e:
     raise RuntimeError(f"Missing required environment variable: {e}")
 
+# 'flask' (threaded development server) or 'asgi' (asyncio server, see asgi.py)
+POLYBOT_SERVER = os.environ.get('POLYBOT_SERVER', 'flask')
+
 
 @app.route('/', methods=['GET'])
 def index():
@@ -29,49 +34,34 @@ def webhook():
 
 @app.route(f'/results', methods=['POST'])
 def results():
-    # Connect to MongoDB
-    client = MongoClient('mongodb://mongodb.default.svc.cluster.local:27017/?replicaSet=rs0')
-    db = client["polybot-info"]
-    collection = db["prediction_images"]
-    # Function to retrieve only the 'prediction_summary' for a given prediction_id
-    def get_prediction_summary(prediction_id):
-        document = collection.find_one({"prediction_id": prediction_id}, {"_id": 0})
-        if document and "_id" in document:
-            document["_id"] = str(document["_id"])
-        return document
-        
-
-    # Example usage
     try:
         prediction_id = request.args.get('predictionId')
         logger.info(f"Received request for prediction_id: {prediction_id}")
     except KeyError as e:
         raise RuntimeError(f"Missing required query parameter: {e}")
     
-    document = get_prediction_summary(prediction_id)
+    # yolo5 sends the prediction summary in the request body, older workers only send the id.
+    # The body is only trusted with the callback token, otherwise the stored prediction is sent to its own chat
+    callback_body = request.get_json(silent=True) if is_trusted_callback(request.headers.get('X-Callback-Token')) else None
+    document = get_prediction_summary(prediction_id, callback_body)
     if document:
         logger.info(f"Results found for prediction_id: {prediction_id}")
-        message = f"Results for prediction {prediction_id}:\n"
-    
-        # Add detected labels
-        if "labels" in document and document["labels"]:
-            message += "\nDetected objects:\n"
-            for i, label in enumerate(document["labels"]):
-                message += f"{i+1}. {label.get('class', 'unknown')} "
-        # Get chat_id from the document
-        try:
-            chat_id = document["chat_id"]
-            # Send the results to the user
-            bot.send_text(chat_id, message)
-            logger.info(f"Results sent to chat_id: {chat_id}")
-            return 'Ok'
-        except KeyError as e:
-            logger.error(f"Missing chat_id in document: {e}")
+        if "chat_id" not in document:
+            logger.error(f"Missing chat_id in document for prediction_id: {prediction_id}")
             return 'Error: chat_id not found in document'
+
+        # Send the annotated image and the results to the user in the background
+        bot.submit(bot.send_prediction_result, document)
+        return 'Ok'
     else:
         logger.error(f"No results found for prediction_id: {prediction_id}")
         return 'No results found'
 
+@app.route('/history', methods=['GET'])
+def history():
+    status, body = query_history(request.args, request.headers.get('X-History-Token'))
+    return jsonify(body), status
+
 @app.route(f'/loadTest/', methods=['POST'])
 def load_test():
     req = request.get_json()
@@ -80,6 +70,11 @@ def load_test():
 
 
 if __name__ == "__main__":
-    bot = ObjectDetectionBot(TELEGRAM_TOKEN, TELEGRAM_APP_URL)
+    if POLYBOT_SERVER == 'asgi':
+        import uvicorn
+        uvicorn.run('asgi:app', host='0.0.0.0', port=8443)
+    else:
+        bot = ObjectDetectionBot(TELEGRAM_TOKEN, TELEGRAM_APP_URL)
+        start_metrics_server()
 
-    app.run(host='0.0.0.0', port=8443)
+        app.run(host='0.0.0.0', port=8443)
@@ -0,0 +1,270 @@
+"""
+Asyncio (ASGI) serving mode of polybot, selected with POLYBOT_SERVER=asgi.
+
+Serves the same routes as the Flask app. Telegram is reached through the pooled, rate limited
+AsyncTelegramClient, and the blocking S3, SQS and MongoDB calls run in a bounded thread pool, so
+a single replica keeps thousands of chats in flight without a server thread per request.
+"""
+import asyncio
+import contextlib
+import json
+import os
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+from botocore.exceptions import NoCredentialsError
+from predictions import (new_trace, upload_photo, enqueue_prediction, enqueue_album, get_prediction_summary, get_result_image,
+                         format_prediction_message, is_trusted_callback, record_cached_prediction,
+                         PREDICTION_FAILED)
+from metrics import FAILURES, observe_delivery, start_metrics_server
+from telegram_api import AsyncTelegramClient
+from cache import prediction_cache, content_key, file_key
+from photos import select_photo_size, prepare_photo
+from scheduler import FairScheduler, AlbumCollector, TOO_MANY_PHOTOS
+from history import get_history_page, get_class_counts, format_history_message, is_history_command, query_history
+
+try:
+    TELEGRAM_TOKEN = os.environ['TELEGRAM_TOKEN']
+    TELEGRAM_APP_URL = os.environ['TELEGRAM_APP_URL']
+except KeyError as e:
+    raise RuntimeError(f"Missing required environment variable: {e}")
+
+# Threads available to the blocking S3, SQS and MongoDB calls
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', '16'))
+
+
+class AsyncObjectDetectionBot:
+
+    def __init__(self, token, telegram_chat_url):
+        self.token = token
+        self.telegram_chat_url = telegram_chat_url
+        self.telegram = AsyncTelegramClient(token)
+        # Keeps a reference to the running background tasks, asyncio only holds weak ones
+        self.tasks = set()
+        # Photos are processed fairly across the chats, at most BOT_WORKERS at a time.
+        # The scheduler and the album timers run on their own threads, and hand the work back to the event loop.
+        self.loop = None
+        self.scheduler = FairScheduler(self._dispatch, concurrency=BOT_WORKERS)
+        self.albums = AlbumCollector(self.schedule_album)
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.scheduler.start()
+        await self.telegram.set_webhook(f'{self.telegram_chat_url}/{self.token}/')
+        logger.info(f'Telegram Bot information\n\n{await self.telegram.get_me()}')
+
+    async def close(self):
+        await self.telegram.close()
+
+    def submit(self, coro):
+        """Runs the coroutine in the background, so the calling HTTP request can return right away"""
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            FAILURES.labels('background_task').inc()
+            logger.opt(exception=task.exception()).error(f'Background task failed: {task.exception()}')
+
+    def _dispatch(self, task):
+        # Called from the scheduler thread
+        self.loop.call_soon_threadsafe(self._run_scheduled, task)
+
+    def _run_scheduled(self, task):
+        self.submit(task()).add_done_callback(lambda _: self.scheduler.done())
+
+    def schedule_photo(self, msg):
+        """Queues a photo behind the other photos of its chat, the photos of an album are collected first"""
+        if msg.get('media_group_id'):
+            self.albums.add(msg)
+        elif not self.scheduler.submit(msg['chat']['id'], partial(self.handle_photo_message, msg)):
+            self.submit(self.telegram.send_message(msg['chat']['id'], TOO_MANY_PHOTOS))
+
+    def schedule_album(self, messages):
+        # Called from an album timer thread, or from the event loop when the album is full
+        chat_id = messages[0]['chat']['id']
+        if not self.scheduler.submit(chat_id, partial(self.handle_album_message, messages), cost=len(messages)):
+            asyncio.run_coroutine_threadsafe(self.telegram.send_message(chat_id, TOO_MANY_PHOTOS), self.loop)
+
+    def is_current_msg_photo(self, msg):
+        return 'photo' in msg
+
+    async def handle_message(self, msg):
+        logger.info(f'Incoming message: {msg}')
+
+        if self.is_current_msg_photo(msg):
+            self.schedule_photo(msg)
+        elif is_history_command(msg):
+            self.submit(self.send_history(msg['chat']['id']))
+        else:
+            self.submit(self.telegram.send_message(msg['chat']['id'], f"this is your message: {msg.get('text')}"))
+
+    async def send_history(self, chat_id):
+        """Answers the /history command with the chat's recent predictions and its class counts"""
+        page, class_counts = await asyncio.gather(asyncio.to_thread(get_history_page, chat_id),
+                                                  asyncio.to_thread(get_class_counts, chat_id))
+        await self.telegram.send_message(chat_id, format_history_message(page, class_counts))
+
+    async def handle_photo_message(self, msg):
+        chat_id = msg['chat']['id']
+        trace = new_trace()
+
+        # A photo that was already predicted (resent, or forwarded from another chat) is answered from the cache
+        photo_file_key = file_key(msg['photo'][-1]['file_unique_id'])
+        cached = await asyncio.to_thread(prediction_cache.get, photo_file_key)
+        if cached:
+            logger.info(f'Prediction cache hit for {photo_file_key}')
+            await self.send_prediction_result({**cached, 'chat_id': chat_id, 'trace': trace})
+            await asyncio.to_thread(record_cached_prediction, chat_id, cached, trace)
+            return
+
+        photo_data = await self.telegram.download_file(select_photo_size(msg['photo'])['file_id'])
+        photo_content_key = content_key(photo_data)
+        cached = await asyncio.to_thread(prediction_cache.get, photo_content_key)
+        if cached:
+            logger.info(f'Prediction cache hit for {photo_content_key}')
+            await asyncio.to_thread(prediction_cache.put, [photo_file_key], cached)
+            await self.send_prediction_result({**cached, 'chat_id': chat_id, 'trace': trace}, photo_data)
+            await asyncio.to_thread(record_cached_prediction, chat_id, cached, trace)
+            return
+
+        try:
+            photo_data = await asyncio.to_thread(prepare_photo, photo_data)
+            img_name = await asyncio.to_thread(upload_photo, chat_id, photo_data)
+        except NoCredentialsError:
+            FAILURES.labels('s3_upload').inc()
+            logger.error("AWS credentials not available.")
+            await self.telegram.send_message(chat_id, PREDICTION_FAILED)
+            return
+        except Exception as e:
+            FAILURES.labels('s3_upload').inc()
+            logger.error(f"Error uploading file: {e}")
+            await self.telegram.send_message(chat_id, PREDICTION_FAILED)
+            return
+
+        try:
+            await asyncio.to_thread(enqueue_prediction, img_name, [photo_content_key, photo_file_key], trace)
+        except Exception as e:
+            FAILURES.labels('sqs_send').inc()
+            logger.error(f"Error sending message to SQS: {e}")
+            await self.telegram.send_message(chat_id, PREDICTION_FAILED)
+
+    async def handle_album_message(self, messages):
+        """Uploads the photos of an album and sends them to yolo5 as a single job"""
+        chat_id = messages[0]['chat']['id']
+        trace = new_trace()
+
+        photos = await asyncio.gather(*(self.telegram.download_file(select_photo_size(msg['photo'])['file_id']) for msg in messages))
+        cache_keys = [[content_key(photo_data), file_key(msg['photo'][-1]['file_unique_id'])]
+                      for photo_data, msg in zip(photos, messages)]
+        try:
+            img_names = await asyncio.gather(
+                *(asyncio.to_thread(lambda data: upload_photo(chat_id, prepare_photo(data)), photo_data) for photo_data in photos))
+        except NoCredentialsError:
+            FAILURES.labels('s3_upload').inc()
+            logger.error("AWS credentials not available.")
+            await self.telegram.send_message(chat_id, PREDICTION_FAILED)
+            return
+        except Exception as e:
+            FAILURES.labels('s3_upload').inc()
+            logger.error(f"Error uploading album: {e}")
+            await self.telegram.send_message(chat_id, PREDICTION_FAILED)
+            return
+
+        try:
+            await asyncio.to_thread(enqueue_album, list(img_names), cache_keys, trace)
+        except Exception as e:
+            FAILURES.labels('sqs_send').inc()
+            logger.error(f"Error sending message to SQS: {e}")
+            await self.telegram.send_message(chat_id, PREDICTION_FAILED)
+
+    async def send_prediction_result(self, document, photo_data=None):
+        """Sends the annotated image and the detected objects of a finished prediction to its chat"""
+        chat_id = document["chat_id"]
+        if document.get("album"):
+            # all the photos of an album go back as one media group
+            result_images = await asyncio.gather(*(asyncio.to_thread(get_result_image, part) for part in document["album"]))
+        else:
+            result_images = [await asyncio.to_thread(get_result_image, document, photo_data)]
+        result_images = [image for image in result_images if image]
+        if result_images:
+            await self.telegram.send_photos(chat_id, result_images)
+            logger.info(f'Sent photo results to the Telegram end-user')
+
+        await self.telegram.send_message(chat_id, format_prediction_message(document))
+        observe_delivery(document)
+        logger.info(f"Results sent to chat_id: {chat_id}")
+
+
+bot = AsyncObjectDetectionBot(TELEGRAM_TOKEN, TELEGRAM_APP_URL)
+
+
+async def index(request):
+    return PlainTextResponse('Ok')
+
+
+async def webhook(request):
+    req = await request.json()
+    await bot.handle_message(req['message'])
+    return PlainTextResponse('Ok')
+
+
+async def results(request):
+    prediction_id = request.query_params.get('predictionId')
+    logger.info(f"Received request for prediction_id: {prediction_id}")
+
+    # yolo5 sends the prediction summary in the request body, older workers only send the id.
+    # The body is only trusted with the callback token, otherwise the stored prediction is sent to its own chat
+    body = await request.body()
+    callback_body = None
+    if body and is_trusted_callback(request.headers.get('X-Callback-Token')):
+        try:
+            callback_body = json.loads(body)
+        except ValueError:
+            # Like Flask's get_json(silent=True), a malformed body falls back to MongoDB
+            logger.warning(f'Malformed callback body for prediction_id: {prediction_id}')
+    document = await asyncio.to_thread(get_prediction_summary, prediction_id, callback_body)
+    if not document:
+        logger.error(f"No results found for prediction_id: {prediction_id}")
+        return PlainTextResponse('No results found')
+
+    logger.info(f"Results found for prediction_id: {prediction_id}")
+    if "chat_id" not in document:
+        logger.error(f"Missing chat_id in document for prediction_id: {prediction_id}")
+        return PlainTextResponse('Error: chat_id not found in document')
+
+    bot.submit(bot.send_prediction_result(document))
+    return PlainTextResponse('Ok')
+
+
+async def history(request):
+    status, body = await asyncio.to_thread(query_history, dict(request.query_params), request.headers.get('X-History-Token'))
+    return JSONResponse(body, status_code=status)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # asyncio.to_thread runs on the loop's default executor, sized for the blocking AWS and Mongo calls
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=BOT_WORKERS, thread_name_prefix='bot'))
+    await bot.start()
+    start_metrics_server()
+    yield
+    await bot.close()
+
+
+app = Starlette(
+    routes=[
+        Route('/', index, methods=['GET']),
+        Route(f'/{TELEGRAM_TOKEN}/', webhook, methods=['POST']),
+        Route('/results', results, methods=['POST']),
+        Route('/history', history, methods=['GET']),
+        Route('/loadTest/', webhook, methods=['POST']),
+    ],
+    lifespan=lifespan,
+)
@@ -2,17 +2,27 @@ import telebot
 from loguru import logger
 import os
 import time
-from telebot.types import InputFile
-import boto3
+from telebot.types import InputFile, InputMediaPhoto
 from botocore.exceptions import NoCredentialsError
-import json
-
-
-try:
-    BUCKET_NAME = os.environ['BUCKET_NAME']
-    SQS_URL = os.environ['SQS_URL']
-except KeyError as e:
-    raise RuntimeError(f"Missing required environment variable: {e}")
+import io
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from predictions import (new_trace, upload_photo, enqueue_prediction, enqueue_album, get_result_image, format_prediction_message,
+                         record_cached_prediction, PREDICTION_FAILED)
+from metrics import TELEGRAM_SECONDS, FAILURES, observe_delivery
+from cache import prediction_cache, content_key, file_key
+from photos import select_photo_size, prepare_photo
+from scheduler import FairScheduler, AlbumCollector, TOO_MANY_PHOTOS
+from history import get_history_page, get_class_counts, format_history_message, is_history_command
+
+# Telegram Bot API server, only overridden to run against a local stand-in (see benchmark/)
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL + '/bot{0}/{1}'
+    telebot.apihelper.FILE_URL = TELEGRAM_API_URL + '/file/bot{0}/{1}'
+
+# Number of background threads that process photos and deliver results, outside of the webhook request
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', '16'))
 
 class Bot:
 
@@ -26,9 +36,43 @@ class Bot:
         # set the webhook URL
         self.telegram_bot_client.set_webhook(url=f'{telegram_chat_url}/{token}/', timeout=60)
         logger.info(f'Telegram Bot information\n\n{self.telegram_bot_client.get_me()}')
+        self.executor = ThreadPoolExecutor(max_workers=BOT_WORKERS, thread_name_prefix='bot')
+        # Photos are processed fairly across the chats, at most BOT_WORKERS at a time
+        self.scheduler = FairScheduler(self._dispatch, concurrency=BOT_WORKERS)
+        self.albums = AlbumCollector(self.schedule_album)
+        self.scheduler.start()
+
+    def submit(self, fn, *args):
+        """Runs `fn(*args)` on the background executor, so the calling HTTP request can return right away"""
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(self._log_failure)
+        return future
+
+    @staticmethod
+    def _log_failure(future):
+        if future.exception() is not None:
+            FAILURES.labels('background_task').inc()
+            logger.opt(exception=future.exception()).error(f'Background task failed: {future.exception()}')
+
+    def _dispatch(self, task):
+        future = self.submit(task)
+        future.add_done_callback(lambda _: self.scheduler.done())
+
+    def schedule_photo(self, msg):
+        """Queues a photo behind the other photos of its chat, the photos of an album are collected first"""
+        if msg.get('media_group_id'):
+            self.albums.add(msg)
+        elif not self.scheduler.submit(msg['chat']['id'], partial(self.handle_photo_message, msg)):
+            self.send_text(msg['chat']['id'], TOO_MANY_PHOTOS)
+
+    def schedule_album(self, messages):
+        chat_id = messages[0]['chat']['id']
+        if not self.scheduler.submit(chat_id, partial(self.handle_album_message, messages), cost=len(messages)):
+            self.send_text(chat_id, TOO_MANY_PHOTOS)
 
     def send_text(self, chat_id, text):
-        self.telegram_bot_client.send_message(chat_id, text)
+        with TELEGRAM_SECONDS.labels('sendMessage').time():
+            self.telegram_bot_client.send_message(chat_id, text)
 
     def send_text_with_quote(self, chat_id, text, quoted_msg_id):
         self.telegram_bot_client.send_message(chat_id, text, reply_to_message_id=quoted_msg_id)
@@ -36,101 +80,153 @@ class Bot:
     def is_current_msg_photo(self, msg):
         return 'photo' in msg
 
-    def download_user_photo(self, msg):
+    def fetch_user_photo(self, msg):
         """
-        Downloads the photos that sent to the Bot to `photos` directory (should be existed)
-        :return:
+        Downloads the photo that was sent to the Bot into memory, without touching the disk.
+        The smallest size Telegram offers that still covers the model's input size is downloaded.
+        :return: the photo content as bytes
         """
         if not self.is_current_msg_photo(msg):
             raise RuntimeError(f'Message content of type \'photo\' expected')
 
-        file_info = self.telegram_bot_client.get_file(msg['photo'][-1]['file_id'])
-        data = self.telegram_bot_client.download_file(file_info.file_path)
-        folder_name = file_info.file_path.split('/')[0]
-
-        if not os.path.exists(folder_name):
-            os.makedirs(folder_name)
-
-        with open(file_info.file_path, 'wb') as photo:
-            photo.write(data)
+        with TELEGRAM_SECONDS.labels('download').time():
+            file_info = self.telegram_bot_client.get_file(select_photo_size(msg['photo'])['file_id'])
+            return self.telegram_bot_client.download_file(file_info.file_path)
 
-        return file_info.file_path
-
-    def send_photo(self, chat_id, img_path):
-        if not os.path.exists(img_path):
-            raise RuntimeError("Image path doesn't exist")
+    def send_photo(self, chat_id, img):
+        """
+        :param img: path of the image on disk, or the encoded image content as bytes
+        """
+        if isinstance(img, (bytes, bytearray)):
+            photo = InputFile(io.BytesIO(img))
+        else:
+            if not os.path.exists(img):
+                raise RuntimeError("Image path doesn't exist")
+            photo = InputFile(img)
+
+        with TELEGRAM_SECONDS.labels('sendPhoto').time():
+            self.telegram_bot_client.send_photo(
+                chat_id,
+                photo
+            )
 
-        self.telegram_bot_client.send_photo(
-            chat_id,
-            InputFile(img_path)
-        )
+    def send_photos(self, chat_id, images):
+        """Sends several encoded images as a single media group (album) reply"""
+        if len(images) == 1:
+            return self.send_photo(chat_id, images[0])
+        with TELEGRAM_SECONDS.labels('sendMediaGroup').time():
+            self.telegram_bot_client.send_media_group(chat_id, [InputMediaPhoto(img) for img in images])
 
     def handle_photo_message(self, msg):
         chat_id = msg['chat']['id']
-        photo_path = self.download_user_photo(msg)
+        trace = new_trace()
+
+        # A photo that was already predicted (resent, or forwarded from another chat) is answered from the cache
+        photo_file_key = file_key(msg['photo'][-1]['file_unique_id'])
+        cached = prediction_cache.get(photo_file_key)
+        if cached:
+            logger.info(f'Prediction cache hit for {photo_file_key}')
+            self.send_prediction_result({**cached, 'chat_id': chat_id, 'trace': trace})
+            record_cached_prediction(chat_id, cached, trace)
+            return
+
+        photo_data = self.fetch_user_photo(msg)
+        photo_content_key = content_key(photo_data)
+        cached = prediction_cache.get(photo_content_key)
+        if cached:
+            logger.info(f'Prediction cache hit for {photo_content_key}')
+            prediction_cache.put([photo_file_key], cached)
+            self.send_prediction_result({**cached, 'chat_id': chat_id, 'trace': trace}, photo_data)
+            record_cached_prediction(chat_id, cached, trace)
+            return
+
         # upload the image to S3 Bucket ofekh-polybotservicedocker-project
-        s3 = boto3.client('s3')
-        bucket_name = BUCKET_NAME
-        run_id = int(time.time())
-        s3_image_key_upload = f'{chat_id}_{str(run_id)}_teleBOT_picture.jpg'
         try:
-            # Upload predicted image back to S3
-            s3.upload_file(str(photo_path), bucket_name, s3_image_key_upload)
-            logger.info(f"File uploaded successfully to {bucket_name}/{s3_image_key_upload}")
-        except FileNotFoundError:
-            logger.error("The file was not found.")
-            return "Predicted image not found", 404
+            img_name = upload_photo(chat_id, prepare_photo(photo_data))
         except NoCredentialsError:
+            FAILURES.labels('s3_upload').inc()
             logger.error("AWS credentials not available.")
-            return "AWS credentials not available", 403
+            self.send_text(chat_id, PREDICTION_FAILED)
+            return
         except Exception as e:
+            FAILURES.labels('s3_upload').inc()
             logger.error(f"Error uploading file: {e}")
-            return f"Error uploading file: {e}", 500
-        
+            self.send_text(chat_id, PREDICTION_FAILED)
+            return
+
         # send an HTTP request to the `SQS` service for prediction
-        params = {"imgName": s3_image_key_upload}
-        sqs_client = boto3.client('sqs', region_name='eu-north-1')
         try:
-            response = sqs_client.send_message(
-                QueueUrl=str(SQS_URL),
-                MessageBody=json.dumps(params)
-            )
-            logger.info(f"Message sent to SQS. Message ID: {response['MessageId']}")
+            enqueue_prediction(img_name, cache_keys=[photo_content_key, photo_file_key], trace=trace)
         except Exception as e:
+            FAILURES.labels('sqs_send').inc()
             logger.error(f"Error sending message to SQS: {e}")
-            return f"Error sending message to SQS: {e}", 500
-        
-        # Download predicted image from S3
-        s3_image_key_download = f'predictions/{s3_image_key_upload}'
-        original_img_path = f'/tmp/image.jpg'  # Temporary storage for downloaded image
-        max_retries = 3 # Number of retries to download the predicted image
+            self.send_text(chat_id, PREDICTION_FAILED)
+
+        # The annotated image is delivered by `send_prediction_result` once yolo5 calls back `/results`
+
+    def handle_album_message(self, messages):
+        """Uploads the photos of an album and sends them to yolo5 as a single job"""
+        chat_id = messages[0]['chat']['id']
+        trace = new_trace()
+
+        img_names = []
+        cache_keys = []
         try:
-            time.sleep(5)  # Wait for the prediction to be completed
-            # Download predicted image from S3
-            s3.download_file(bucket_name, s3_image_key_download, original_img_path)
-            logger.info(f'Downloaded prediction image completed from {bucket_name}/{s3_image_key_download}')
-            # send photo results to the Telegram end-user
-            self.send_photo(chat_id, original_img_path)
-            logger.info(f'Sent photo results to the Telegram end-user')
-        except FileNotFoundError:
-            logger.error("The file was not found.")
-            return "Predicted image not found", 404
+            for msg in messages:
+                photo_data = self.fetch_user_photo(msg)
+                img_names.append(upload_photo(chat_id, prepare_photo(photo_data)))
+                cache_keys.append([content_key(photo_data), file_key(msg['photo'][-1]['file_unique_id'])])
         except NoCredentialsError:
+            FAILURES.labels('s3_upload').inc()
             logger.error("AWS credentials not available.")
-            return "AWS credentials not available", 403
+            self.send_text(chat_id, PREDICTION_FAILED)
+            return
+        except Exception as e:
+            FAILURES.labels('s3_upload').inc()
+            logger.error(f"Error uploading album: {e}")
+            self.send_text(chat_id, PREDICTION_FAILED)
+            return
+
+        try:
+            enqueue_album(img_names, cache_keys=cache_keys, trace=trace)
         except Exception as e:
-            logger.error(f"Error downloading file: {e}")
-            return f"Error downloading file: {e}", 500
-            
+            FAILURES.labels('sqs_send').inc()
+            logger.error(f"Error sending message to SQS: {e}")
+            self.send_text(chat_id, PREDICTION_FAILED)
+
+    def send_prediction_result(self, document, photo_data=None):
+        """
+        Sends the annotated image and the detected objects of a finished prediction to its chat
+        :param photo_data: the original photo, when it is already in memory
+        """
+        chat_id = document["chat_id"]
+        if document.get("album"):
+            # all the photos of an album go back as one media group
+            result_images = [image for image in map(get_result_image, document["album"]) if image]
+        else:
+            result_images = [image for image in [get_result_image(document, photo_data)] if image]
+        if result_images:
+            # send photo results to the Telegram end-user
+            self.send_photos(chat_id, result_images)
+            logger.info(f'Sent photo results to the Telegram end-user')
+
+        self.send_text(chat_id, format_prediction_message(document))
+        observe_delivery(document)
+        logger.info(f"Results sent to chat_id: {chat_id}")
+
+    def send_history(self, chat_id):
+        """Answers the /history command with the chat's recent predictions and its class counts"""
+        self.send_text(chat_id, format_history_message(get_history_page(chat_id), get_class_counts(chat_id)))
 
-    
     def handle_message(self, msg):
         """Bot Main message handler"""
         logger.info(f'Incoming message: {msg}')
-        if 'text' in msg:
+        if is_history_command(msg):
+            self.submit(self.send_history, msg['chat']['id'])
+        elif 'text' in msg:
             self.send_text(msg['chat']['id'], f'Your original message: {msg["text"]}')
         elif self.is_current_msg_photo(msg):
-            self.handle_photo_message(msg)
+            self.schedule_photo(msg)
         else:
             self.send_text(msg['chat']['id'], "Unsupported message type")
         
@@ -140,7 +236,10 @@ class ObjectDetectionBot(Bot):
         logger.info(f'Incoming message: {msg}')
 
         if self.is_current_msg_photo(msg):
-            self.handle_photo_message(msg)
+            # Acknowledge the webhook right away, the photo is uploaded and queued in the background, fairly across the chats
+            self.schedule_photo(msg)
+        elif is_history_command(msg):
+            self.submit(self.send_history, msg['chat']['id'])
         else:
             self.send_text(msg['chat']['id'], f"this is your message: {msg['text']}")
 
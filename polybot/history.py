@@ -0,0 +1,108 @@
+"""
+Prediction history of a chat, read from `polybot-info.prediction_images`.
+
+Both queries are served by yolo5's `chat_id_time` index (chat_id asc, time desc) and only bring
+back the fields they need: pages are keyset-paged on the prediction time, so the 1000th page costs
+the same as the first, and the class counts are computed by MongoDB, not in Python.
+Note that yolo5 stores `chat_id` as a string (the prefix of the image name).
+"""
+import datetime
+import hmac
+import os
+from collections import Counter
+from clients import get_mongo_client
+from metrics import HISTORY_SECONDS
+
+HISTORY_PAGE_SIZE = int(os.environ.get('HISTORY_PAGE_SIZE', '10'))
+# Token the GET /history endpoint requires in its X-History-Token header, the endpoint is disabled when unset
+HISTORY_API_TOKEN = os.environ.get('HISTORY_API_TOKEN')
+HISTORY_MAX_PAGE_SIZE = 100
+HISTORY_TOP_CLASSES = 10
+
+HISTORY_PROJECTION = {'_id': 0, 'prediction_id': 1, 'time': 1, 'labels.class': 1}
+
+
+def get_predictions_collection():
+    return get_mongo_client()['polybot-info']['prediction_images']
+
+
+def get_history_page(chat_id, before=None, limit=HISTORY_PAGE_SIZE):
+    """
+    :param before: `next_before` of the previous page, None for the newest predictions
+    :return: dict with the page `items` (newest first) and the `next_before` cursor, None on the last page
+    """
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    query = {'chat_id': str(chat_id)}
+    if before is not None:
+        query['time'] = {'$lt': before}
+
+    items = []
+    with HISTORY_SECONDS.labels('page').time():
+        # One extra document tells whether there is a next page
+        cursor = get_predictions_collection().find(query, HISTORY_PROJECTION).sort('time', -1).limit(limit + 1).batch_size(limit + 1)
+        for document in cursor:
+            classes = Counter(label.get('class', 'unknown') for label in document.get('labels') or [])
+            items.append({'prediction_id': document['prediction_id'], 'time': document['time'], 'classes': dict(classes)})
+
+    next_before = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_before = items[-1]['time']
+    return {'items': items, 'next_before': next_before}
+
+
+def get_class_counts(chat_id, top=HISTORY_TOP_CLASSES):
+    """:return: list of (class, count) over all the chat's predictions, most frequent first"""
+    pipeline = [
+        {'$match': {'chat_id': str(chat_id)}},
+        {'$project': {'_id': 0, 'labels.class': 1}},
+        {'$unwind': '$labels'},
+        {'$group': {'_id': '$labels.class', 'count': {'$sum': 1}}},
+        {'$sort': {'count': -1, '_id': 1}},
+        {'$limit': top},
+    ]
+    with HISTORY_SECONDS.labels('class_counts').time():
+        return [(row['_id'], row['count']) for row in get_predictions_collection().aggregate(pipeline)]
+
+
+def query_history(params, token):
+    """
+    Serves the GET /history endpoint of both the Flask and the ASGI servers
+    :param params: the query parameters: chatId, and the optional before (cursor) and limit
+    :param token: the request's X-History-Token header
+    :return: (HTTP status, JSON body). The first page also holds the chat's class counts.
+    """
+    if not HISTORY_API_TOKEN:
+        return 404, {'error': 'Not found'}
+    if not hmac.compare_digest(token or '', HISTORY_API_TOKEN):
+        return 401, {'error': 'Invalid history token'}
+    if not params.get('chatId'):
+        return 400, {'error': 'Missing chatId'}
+    try:
+        before = float(params['before']) if params.get('before') else None
+        limit = int(params.get('limit', HISTORY_PAGE_SIZE))
+    except ValueError as e:
+        return 400, {'error': f'Invalid paging parameter: {e}'}
+
+    page = get_history_page(params['chatId'], before, limit)
+    if before is None:
+        page['class_counts'] = [{'class': name, 'count': count} for name, count in get_class_counts(params['chatId'])]
+    return 200, page
+
+
+def is_history_command(msg):
+    return msg.get('text', '').split('@')[0].strip() == '/history'
+
+
+def format_history_message(page, class_counts):
+    if not page['items']:
+        return "You don't have any predictions yet, send me a photo!"
+
+    message = 'Objects in all your photos:\n'
+    message += '\n'.join(f'{name} ×{count}' for name, count in class_counts) or 'none'
+    message += f'\n\nYour last {len(page["items"])} predictions:\n'
+    for item in page['items']:
+        when = datetime.datetime.fromtimestamp(item['time'], datetime.timezone.utc).strftime('%Y-%m-%d %H:%M UTC')
+        objects = ', '.join(f'{name} ×{count}' for name, count in item['classes'].items()) or 'no objects'
+        message += f'{when}: {objects}\n'
+    return message
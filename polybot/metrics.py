@@ -0,0 +1,51 @@
+"""
+Prometheus metrics of polybot, served at /metrics on METRICS_PORT, apart from the port the ingress
+exposes to the internet.
+"""
+import os
+import time
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY, start_http_server
+from prometheus_client.core import CounterMetricFamily
+from cache import prediction_cache
+
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '8081'))
+
+# Latency buckets from a few milliseconds (Mongo, S3 on a warm connection) up to slow predictions of minutes
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+TELEGRAM_SECONDS = Histogram('polybot_telegram_seconds', 'Telegram Bot API request latency', ['method'], buckets=LATENCY_BUCKETS)
+S3_SECONDS = Histogram('polybot_s3_seconds', 'S3 request latency', ['operation'], buckets=LATENCY_BUCKETS)
+SQS_SEND_SECONDS = Histogram('polybot_sqs_send_seconds', 'Latency of enqueuing a prediction job', buckets=LATENCY_BUCKETS)
+MONGO_FIND_SECONDS = Histogram('polybot_mongo_find_seconds', 'Latency of reading a prediction summary from MongoDB', buckets=LATENCY_BUCKETS)
+SUMMARY_LOOKUPS = Counter('polybot_summary_lookups_total', 'Prediction summary lookups of /results', ['source'])
+PREDICTION_SECONDS = Histogram('polybot_prediction_seconds', 'Time from receiving a photo until its result was sent to the chat', buckets=LATENCY_BUCKETS)
+FAILURES = Counter('polybot_failures_total', 'Failed steps of the photo flow', ['step'])
+SCHEDULER_PENDING = Gauge('polybot_scheduler_pending', 'Photo tasks waiting in the per-chat scheduler queues')
+SCHEDULER_WAIT_SECONDS = Histogram('polybot_scheduler_wait_seconds', 'Time a photo task waited in the scheduler', buckets=LATENCY_BUCKETS)
+SCHEDULER_REJECTED = Counter('polybot_scheduler_rejected_total', 'Photo tasks refused because their chat had too many pending')
+HISTORY_SECONDS = Histogram('polybot_history_seconds', 'Latency of the prediction history queries', ['query'], buckets=LATENCY_BUCKETS)
+RESULT_IMAGES = Counter('polybot_result_images_total', 'Annotated result images, downloaded from S3 or rendered by polybot', ['source'])
+PHOTO_BYTES = Histogram('polybot_photo_bytes', 'Size of the photos sent for prediction, as downloaded from Telegram and as uploaded to S3',
+                        ['stage'], buckets=(10e3, 25e3, 50e3, 100e3, 200e3, 400e3, 800e3, 1.6e6, 3.2e6))
+
+
+class PredictionCacheCollector:
+    """Exports the hit/miss counters the prediction cache keeps by itself"""
+
+    def collect(self):
+        yield CounterMetricFamily('polybot_prediction_cache_hits', 'Prediction cache hits', value=prediction_cache.hits)
+        yield CounterMetricFamily('polybot_prediction_cache_misses', 'Prediction cache misses', value=prediction_cache.misses)
+
+
+REGISTRY.register(PredictionCacheCollector())
+
+
+def observe_delivery(document):
+    """Records the end-to-end latency of a delivered prediction, using the trace context polybot started"""
+    received_at = (document.get('trace') or {}).get('received_at')
+    if received_at:
+        PREDICTION_SECONDS.observe(max(0, time.time() - received_at))
+
+
+def start_metrics_server():
+    start_http_server(METRICS_PORT)
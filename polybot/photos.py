@@ -0,0 +1,42 @@
+"""
+Picks and prepares the photo that is sent to yolo5.
+
+Telegram offers every photo in several sizes. yolo5 letterboxes its input down to the model's
+input size anyway, so the smallest size that still covers it is downloaded instead of the largest
+one, and can optionally be re-encoded at a lower JPEG quality before the S3 upload.
+"""
+import io
+import os
+from PIL import Image
+from metrics import PHOTO_BYTES
+
+# Inference image size of yolo5 (its IMG_SIZE), the longest side of the selected photo size covers it
+MODEL_INPUT_SIZE = int(os.environ.get('MODEL_INPUT_SIZE', '640'))
+# JPEG quality the photo is re-encoded at before the upload, 0 uploads it as downloaded
+PHOTO_REENCODE_QUALITY = int(os.environ.get('PHOTO_REENCODE_QUALITY', '0'))
+
+
+def select_photo_size(sizes, min_side=MODEL_INPUT_SIZE):
+    """
+    :param sizes: the `photo` array of a Telegram message, ordered from the smallest to the largest size
+    :return: the smallest size whose longest side covers `min_side`, the largest size when none does
+    """
+    for size in sorted(sizes, key=lambda size: size['width'] * size['height']):
+        if max(size['width'], size['height']) >= min_side:
+            return size
+    return sizes[-1]
+
+
+def prepare_photo(data, quality=PHOTO_REENCODE_QUALITY):
+    """
+    Re-encodes the downloaded photo at the target JPEG quality, when one is set.
+    :return: the photo to upload, the downloaded one if re-encoding does not make it smaller
+    """
+    PHOTO_BYTES.labels('downloaded').observe(len(data))
+    if quality:
+        buffer = io.BytesIO()
+        Image.open(io.BytesIO(data)).convert('RGB').save(buffer, format='JPEG', quality=quality, optimize=True)
+        if buffer.tell() < len(data):
+            data = buffer.getvalue()
+    PHOTO_BYTES.labels('uploaded').observe(len(data))
+    return data
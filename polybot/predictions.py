@@ -0,0 +1,238 @@
+"""
+The S3, SQS and MongoDB side of a prediction, shared by the Flask and the ASGI servers.
+
+All functions here are blocking; the ASGI server runs them in worker threads.
+"""
+import hmac
+import json
+import os
+import time
+import uuid
+from loguru import logger
+from clients import get_s3_client, get_sqs_client, get_mongo_client
+from cache import TTLCache
+from metrics import S3_SECONDS, SQS_SEND_SECONDS, MONGO_FIND_SECONDS, SUMMARY_LOOKUPS, RESULT_IMAGES, FAILURES
+from render import render_prediction
+
+
+try:
+    BUCKET_NAME = os.environ['BUCKET_NAME']
+    SQS_URL = os.environ['SQS_URL']
+except KeyError as e:
+    raise RuntimeError(f"Missing required environment variable: {e}")
+
+# Recently finished predictions, so repeated /results lookups of the same prediction don't hit MongoDB
+RECENT_SUMMARIES_SIZE = int(os.environ.get('RECENT_SUMMARIES_SIZE', '1000'))
+RECENT_SUMMARIES_TTL = int(os.environ.get('RECENT_SUMMARIES_TTL', '600'))
+recent_summaries = TTLCache(RECENT_SUMMARIES_SIZE, RECENT_SUMMARIES_TTL)
+
+# Shared secret yolo5 sends in the X-Callback-Token header of its /results callbacks. The summary in a callback
+# body is only used when the header matches, any other /results request is answered from MongoDB.
+CALLBACK_TOKEN = os.environ.get('CALLBACK_TOKEN')
+
+# Recently uploaded photos by S3 key, the results of yolo5's `boxes` delivery mode are drawn on them without an S3 download
+RECENT_PHOTOS_SIZE = int(os.environ.get('RECENT_PHOTOS_SIZE', '200'))
+RECENT_PHOTOS_TTL = int(os.environ.get('RECENT_PHOTOS_TTL', '600'))
+recent_photos = TTLCache(RECENT_PHOTOS_SIZE, RECENT_PHOTOS_TTL)
+
+
+def new_trace():
+    """
+    Starts the trace context of a photo. It travels in the SQS job and the yolo5 callback,
+    so the prediction can be correlated across both services.
+    """
+    return {'trace_id': uuid.uuid4().hex, 'received_at': time.time()}
+
+
+def upload_photo(chat_id, photo_data):
+    """
+    Uploads the photo of a chat to the S3 bucket
+    :return: the S3 key of the image, which is also the job's `imgName`
+    """
+    run_id = time.time_ns()  # unique per photo, even for several photos of the same chat within a second
+    s3_image_key_upload = f'{chat_id}_{str(run_id)}_teleBOT_picture.jpg'
+    with S3_SECONDS.labels('upload').time():
+        get_s3_client().put_object(Bucket=BUCKET_NAME, Key=s3_image_key_upload, Body=photo_data, ContentType='image/jpeg')
+    logger.info(f"File uploaded successfully to {BUCKET_NAME}/{s3_image_key_upload}")
+    recent_photos.put(s3_image_key_upload, photo_data)
+    return s3_image_key_upload
+
+
+def enqueue_prediction(img_name, cache_keys=None, trace=None):
+    """
+    Sends a prediction job to the yolo5 workers through SQS
+    :param cache_keys: prediction cache keys of the image, yolo5 stores the result under them
+    :param trace: trace context from `new_trace`
+    :return: the SQS MessageId, which yolo5 uses as the prediction id
+    """
+    params = {"imgName": img_name}
+    if cache_keys:
+        params["cacheKeys"] = cache_keys
+    return _send_job(params, trace)
+
+
+def enqueue_album(img_names, cache_keys=None, trace=None):
+    """
+    Sends the photos of an album as a single job, yolo5 infers them together and answers with one callback
+    :param cache_keys: list with the prediction cache keys of every image
+    :return: the SQS MessageId, which yolo5 uses as the album's prediction id
+    """
+    params = {"imgNames": img_names}
+    if cache_keys:
+        params["cacheKeys"] = cache_keys
+    return _send_job(params, trace)
+
+
+def _send_job(params, trace):
+    params["trace"] = {**(trace or new_trace()), 'enqueued_at': time.time()}
+    with SQS_SEND_SECONDS.time():
+        response = get_sqs_client().send_message(
+            QueueUrl=str(SQS_URL),
+            MessageBody=json.dumps(params)
+        )
+    logger.info(f"Message sent to SQS. Message ID: {response['MessageId']}. trace: {params['trace']['trace_id']}")
+    return response['MessageId']
+
+
+# The only fields the result delivery needs, the rest of the document is never read back.
+# `album` is only set on the summary of an album, it holds the summary of every photo.
+SUMMARY_PROJECTION = {"_id": 0, "prediction_id": 1, "chat_id": 1, "labels": 1, "original_img_path": 1, "predicted_img_path": 1,
+                      "trace": 1, "error": 1}
+SUMMARY_FIELDS = [field for field in SUMMARY_PROJECTION if field != "_id"] + ["album"]
+
+
+def is_trusted_callback(token):
+    """:param token: the X-Callback-Token header of a /results request"""
+    return bool(CALLBACK_TOKEN) and hmac.compare_digest(token or '', CALLBACK_TOKEN)
+
+
+def _chat_image_paths(summary, chat_id):
+    """
+    Drops the S3 keys of a callback summary that aren't images of its own chat: polybot uploads the photos of
+    a chat as `{chat_id}_...`, yolo5 their annotated images as `predictions/{chat_id}_...`. A prediction cache
+    hit on the annotated image of another chat is then drawn on the chat's own photo.
+    """
+    summary = dict(summary)
+    for field, prefix in (("original_img_path", f"{chat_id}_"), ("predicted_img_path", f"predictions/{chat_id}_")):
+        if summary.get(field) and not str(summary[field]).startswith(prefix):
+            summary[field] = None
+    return summary
+
+
+def remember_prediction_summary(document):
+    recent_summaries.put(document["prediction_id"], document)
+
+
+def get_prediction_summary(prediction_id, callback_body=None):
+    """
+    Retrieves the prediction summary of the given prediction_id
+    :param callback_body: the summary yolo5 sent along with an authenticated `/results` callback (see
+                          `is_trusted_callback`), if any. MongoDB is only read when it's missing and the
+                          summary isn't cached.
+    """
+    if callback_body and callback_body.get("prediction_id") == prediction_id and "chat_id" in callback_body:
+        document = {field: callback_body.get(field) for field in SUMMARY_FIELDS if field in callback_body}
+        chat_id = document["chat_id"]
+        document = _chat_image_paths(document, chat_id)
+        if document.get("album"):
+            document["album"] = [_chat_image_paths(part, chat_id) for part in document["album"]]
+        remember_prediction_summary(document)
+        SUMMARY_LOOKUPS.labels('callback').inc()
+        return document
+
+    document = recent_summaries.get(prediction_id)
+    if document is not None:
+        SUMMARY_LOOKUPS.labels('cache').inc()
+        return document
+
+    collection = get_mongo_client()["polybot-info"]["prediction_images"]
+    # Served by the unique prediction_id index yolo5 creates at startup
+    SUMMARY_LOOKUPS.labels('mongo').inc()
+    with MONGO_FIND_SECONDS.time():
+        document = collection.find_one({"prediction_id": prediction_id}, SUMMARY_PROJECTION)
+        if document is None:
+            # yolo5 stores every photo of an album as its own document, tagged with the album's id
+            parts = list(collection.find({"album_id": prediction_id}, SUMMARY_PROJECTION).sort("album_index", 1))
+            if parts:
+                document = {"prediction_id": prediction_id, "chat_id": parts[0]["chat_id"],
+                            "trace": parts[0].get("trace"), "album": parts}
+    if document:
+        remember_prediction_summary(document)
+    return document
+
+
+def record_cached_prediction(chat_id, cached, trace):
+    """
+    Stores the summary of a photo answered from the prediction cache, which never reaches yolo5, so it
+    shows in the chat's history like the predictions (and the cache hits) of the worker
+    :param cached: the prediction cache value, its prediction is kept as `cached_prediction_id`
+    """
+    document = {
+        "prediction_id": uuid.uuid4().hex,
+        "cached_prediction_id": cached.get("prediction_id"),
+        "chat_id": str(chat_id),
+        "labels": cached.get("labels") or [],
+        "original_img_path": cached.get("original_img_path"),
+        "predicted_img_path": cached.get("predicted_img_path"),
+        "trace": trace,
+        "time": time.time(),
+    }
+    try:
+        get_mongo_client()["polybot-info"]["prediction_images"].insert_one(document)
+    except Exception as e:
+        # The user already has the result, only the history misses it
+        FAILURES.labels('history_record').inc()
+        logger.error(f"Error recording cached prediction {document['cached_prediction_id']} for chat {chat_id}: {e}")
+
+
+def download_predicted_image(s3_key):
+    """Downloads an image of a prediction (the annotated one, or the original photo) from S3 into memory"""
+    with S3_SECONDS.labels('download').time():
+        predicted_img = get_s3_client().get_object(Bucket=BUCKET_NAME, Key=s3_key)['Body'].read()
+    logger.info(f'Downloaded prediction image completed from {BUCKET_NAME}/{s3_key}')
+    return predicted_img
+
+
+def get_result_image(document, photo_data=None):
+    """
+    Gets the annotated image of a prediction: the one yolo5 uploaded to S3, or, when yolo5 only
+    stored the boxes, the original photo with the boxes drawn on it.
+    :param photo_data: the original photo, when the caller already has it in memory
+    :return: the JPEG encoded image, or None when there is neither an annotated image nor an original photo
+    """
+    if document.get("error"):
+        return None
+    if document.get("predicted_img_path"):
+        RESULT_IMAGES.labels('s3').inc()
+        return download_predicted_image(document["predicted_img_path"])
+
+    original_img_path = document.get("original_img_path")
+    if photo_data is None and original_img_path:
+        photo_data = recent_photos.get(original_img_path)
+        if photo_data is None:
+            photo_data = download_predicted_image(original_img_path)
+    if photo_data is None:
+        return None
+    RESULT_IMAGES.labels('rendered').inc()
+    return render_prediction(photo_data, document.get("labels") or [])
+
+
+PREDICTION_FAILED = 'Sorry, I could not process your photo, please try again later'
+
+
+def format_prediction_message(document):
+    if document.get("album"):
+        message = f"Results for album {document['prediction_id']}:\n"
+        for i, part in enumerate(document["album"]):
+            classes = ", ".join(label.get('class', 'unknown') for label in part.get("labels") or []) or "no objects"
+            message += f"\nPhoto {i+1}: {classes}"
+        return message
+
+    message = f"Results for prediction {document['prediction_id']}:\n"
+
+    # Add detected labels
+    if "labels" in document and document["labels"]:
+        message += "\nDetected objects:\n"
+        for i, label in enumerate(document["labels"]):
+            message += f"{i+1}. {label.get('class', 'unknown')} "
+    return message
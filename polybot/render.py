@@ -0,0 +1,65 @@
+"""
+Draws the detections of a prediction on the original photo, for the `boxes` result delivery mode
+of yolo5 (RESULT_DELIVERY), where the worker stores only the boxes and no annotated image.
+"""
+import io
+import zlib
+from PIL import Image, ImageDraw, ImageFont
+
+# Same palette as yolov5's utils.plots.Colors, which picks the color of a class by its index
+PALETTE = ('FF3838', 'FF9D97', 'FF701F', 'FFB21D', 'CFD231', '48F90A', '92CC17', '3DDB86', '1A9334', '00D4BB',
+           '2C99A8', '00C2FF', '344593', '6473FF', '0018EC', '8438FF', '520085', 'CB38FF', 'FF95C8', 'FF37C7')
+# Class names of the COCO model yolo5 runs, in index order
+COCO_NAMES = (
+    'person', 'bicycle', 'car', 'motorcycle', 'airplane', 'bus', 'train', 'truck', 'boat', 'traffic light',
+    'fire hydrant', 'stop sign', 'parking meter', 'bench', 'bird', 'cat', 'dog', 'horse', 'sheep', 'cow',
+    'elephant', 'bear', 'zebra', 'giraffe', 'backpack', 'umbrella', 'handbag', 'tie', 'suitcase', 'frisbee',
+    'skis', 'snowboard', 'sports ball', 'kite', 'baseball bat', 'baseball glove', 'skateboard', 'surfboard',
+    'tennis racket', 'bottle', 'wine glass', 'cup', 'fork', 'knife', 'spoon', 'bowl', 'banana', 'apple',
+    'sandwich', 'orange', 'broccoli', 'carrot', 'hot dog', 'pizza', 'donut', 'cake', 'chair', 'couch',
+    'potted plant', 'bed', 'dining table', 'toilet', 'tv', 'laptop', 'mouse', 'remote', 'keyboard', 'cell phone',
+    'microwave', 'oven', 'toaster', 'sink', 'refrigerator', 'book', 'clock', 'vase', 'scissors', 'teddy bear',
+    'hair drier', 'toothbrush')
+COCO_INDEX = {name: i for i, name in enumerate(COCO_NAMES)}
+RENDER_QUALITY = 90
+
+
+def class_color(name):
+    """The color yolov5 draws a COCO class with, so both delivery modes look alike. Other classes get a stable color by name."""
+    index = COCO_INDEX.get(name)
+    if index is None:
+        index = zlib.crc32(name.encode())
+    color = PALETTE[index % len(PALETTE)]
+    return tuple(int(color[i:i + 2], 16) for i in (0, 2, 4))
+
+
+def render_prediction(photo_data, labels):
+    """
+    :param photo_data: the encoded original photo
+    :param labels: detections with normalized `cx, cy, width, height`, as stored by yolo5
+    :return: the annotated photo, JPEG encoded
+    """
+    img = Image.open(io.BytesIO(photo_data)).convert('RGB')
+    w, h = img.size
+    draw = ImageDraw.Draw(img)
+    line_width = max(round((w + h) / 2 * 0.003), 2)
+    font = ImageFont.load_default()
+
+    for label in labels:
+        x1 = (label['cx'] - label['width'] / 2) * w
+        y1 = (label['cy'] - label['height'] / 2) * h
+        x2 = (label['cx'] + label['width'] / 2) * w
+        y2 = (label['cy'] + label['height'] / 2) * h
+        color = class_color(label['class'])
+        draw.rectangle((x1, y1, x2, y2), outline=color, width=line_width)
+
+        text = f"{label['class']} {label['confidence']:.2f}"
+        left, top, right, bottom = draw.textbbox((0, 0), text, font=font)
+        text_w, text_h = right - left, bottom - top + 4
+        text_y = y1 - text_h if y1 >= text_h else y1
+        draw.rectangle((x1, text_y, x1 + text_w + 4, text_y + text_h), fill=color)
+        draw.text((x1 + 2, text_y + 2 - top), text, fill=(255, 255, 255), font=font)
+
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=RENDER_QUALITY)
+    return buffer.getvalue()
@@ -0,0 +1,168 @@
+"""
+Fair scheduling of the photo work between the chats, and coalescing of Telegram albums.
+
+Photos used to be processed in arrival order, so one chat sending a 10-photo album, or flooding the
+bot, made every other chat wait behind it. The FairScheduler keeps one queue per chat and hands the
+work to a bounded number of workers round-robin across the chats, and every chat draws from its own
+token bucket: a chat over its rate waits, the others keep being served.
+
+The photos of an album arrive as separate updates sharing a `media_group_id`; the AlbumCollector
+waits until the album is complete and turns it into a single task (one SQS job, one reply).
+"""
+import os
+import threading
+import time
+from collections import deque
+from loguru import logger
+from token_bucket import TokenBucket
+from metrics import SCHEDULER_PENDING, SCHEDULER_WAIT_SECONDS, SCHEDULER_REJECTED
+
+# Sustained photos per second of a single chat, and the burst it can send at once (a full album is 10 photos)
+CHAT_PHOTO_RATE = float(os.environ.get('CHAT_PHOTO_RATE', '1'))
+CHAT_PHOTO_BURST = int(os.environ.get('CHAT_PHOTO_BURST', '10'))
+# Tasks a chat can have waiting, further photos are refused until its queue drains
+CHAT_MAX_PENDING = int(os.environ.get('CHAT_MAX_PENDING', '20'))
+# Seconds without a new photo after which an album is considered complete
+ALBUM_WAIT = float(os.environ.get('ALBUM_WAIT', '1.0'))
+# Telegram albums hold at most 10 photos
+ALBUM_MAX_SIZE = 10
+
+TOO_MANY_PHOTOS = 'You have too many photos in progress, please wait for their results before sending more'
+
+
+class FairScheduler:
+    """
+    Runs submitted tasks through `dispatch(task)`, at most `concurrency` at a time. The caller calls
+    `done()` once a dispatched task is finished. Tasks of the same chat run in submission order.
+    """
+
+    def __init__(self, dispatch, concurrency, chat_rate=CHAT_PHOTO_RATE, chat_burst=CHAT_PHOTO_BURST,
+                 max_pending=CHAT_MAX_PENDING):
+        self.dispatch = dispatch
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_pending = max_pending
+        self.slots = threading.Semaphore(concurrency)
+        # chat_id -> deque of (task, cost, submit time); `ready` is the round-robin order of chats with pending tasks
+        self.queues = {}
+        self.buckets = {}
+        self.ready = deque()
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+        SCHEDULER_PENDING.set_function(lambda: self.pending)
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, chat_id, task, cost=1):
+        """
+        :param cost: number of photos of the task, taken from the chat's token bucket
+        :return: False when the chat has too many pending tasks and the task was refused
+        """
+        with self.lock:
+            queue = self.queues.get(chat_id)
+            if queue is None:
+                queue = self.queues[chat_id] = deque()
+                self.ready.append(chat_id)
+            elif len(queue) >= self.max_pending:
+                SCHEDULER_REJECTED.inc()
+                return False
+            queue.append((task, cost, time.time()))
+            self.pending += 1
+            self.changed.notify()
+        return True
+
+    def done(self):
+        self.slots.release()
+
+    def _bucket(self, chat_id):
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            if len(self.buckets) > 10000:
+                # Full buckets carry no state, they are recreated on the chat's next photo
+                for idle in [chat for chat, b in self.buckets.items() if b.is_idle() and chat not in self.queues]:
+                    del self.buckets[idle]
+            bucket = self.buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _next_task(self):
+        """Takes the next task, round-robin over the chats that have tokens. Called with the lock held."""
+        while True:
+            wait = None
+            for _ in range(len(self.ready)):
+                chat_id = self.ready[0]
+                self.ready.rotate(-1)
+                queue = self.queues[chat_id]
+                task, cost, submitted = queue[0]
+                bucket = self._bucket(chat_id)
+                if bucket.try_take(cost):
+                    queue.popleft()
+                    self.pending -= 1
+                    if not queue:
+                        del self.queues[chat_id]
+                        self.ready.remove(chat_id)
+                    SCHEDULER_WAIT_SECONDS.observe(time.time() - submitted)
+                    return task
+                chat_wait = bucket.wait_time(cost)
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+            # Nothing is runnable: wait for a new task, or for the first chat to get its tokens back
+            self.changed.wait(timeout=wait)
+
+    def _run(self):
+        while True:
+            self.slots.acquire()
+            with self.lock:
+                task = self._next_task()
+            try:
+                self.dispatch(task)
+            except Exception as e:
+                self.done()
+                logger.exception(f'Could not dispatch a scheduled task: {e}')
+
+
+class AlbumCollector:
+    """
+    Collects the messages of an album, keyed by chat and `media_group_id`, and calls `on_album(messages)`
+    once no new photo arrived for `wait` seconds, or the album is full.
+    """
+
+    def __init__(self, on_album, wait=ALBUM_WAIT):
+        self.on_album = on_album
+        self.wait = wait
+        self.albums = {}
+        self.lock = threading.Lock()
+
+    def add(self, msg):
+        key = (msg['chat']['id'], msg['media_group_id'])
+        with self.lock:
+            messages, timer = self.albums.get(key, ([], None))
+            if timer is not None:
+                timer.cancel()
+            messages.append(msg)
+            if len(messages) >= ALBUM_MAX_SIZE:
+                self.albums.pop(key, None)
+                complete = True
+            else:
+                timer = threading.Timer(self.wait, self._flush, args=(key,))
+                timer.daemon = True
+                self.albums[key] = (messages, timer)
+                timer.start()
+                complete = False
+        if complete:
+            self._emit(messages)
+
+    def _flush(self, key):
+        with self.lock:
+            messages, _ = self.albums.pop(key, (None, None))
+        if messages:
+            self._emit(messages)
+
+    def _emit(self, messages):
+        # Telegram may deliver the updates of an album out of order
+        messages.sort(key=lambda msg: msg['message_id'])
+        try:
+            self.on_album(messages)
+        except Exception as e:
+            logger.exception(f'Could not schedule album {messages[0]["media_group_id"]}: {e}')
@@ -0,0 +1,119 @@
+"""
+Async client of the Telegram Bot API, used by the ASGI server.
+
+A single pooled httpx session is kept open for the process lifetime, and every outgoing message
+goes through a RateLimiter that follows Telegram's limits (about 1 message per second per chat,
+30 messages per second overall). Messages over the limit wait in line instead of failing with 429.
+"""
+import asyncio
+import json
+import os
+import httpx
+from loguru import logger
+from metrics import TELEGRAM_SECONDS
+from token_bucket import TokenBucket
+
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+TELEGRAM_MAX_CONNECTIONS = int(os.environ.get('TELEGRAM_MAX_CONNECTIONS', '100'))
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', '30'))
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_CHAT_BURST = int(os.environ.get('TELEGRAM_CHAT_BURST', '3'))
+# Number of attempts of a request Telegram keeps answering with 429 Too Many Requests
+TELEGRAM_MAX_RETRIES = 5
+
+
+class RateLimiter:
+    """
+    Per-chat and global token buckets. Since tokens are reserved in call order, callers over the
+    limit are served first-come first-served. Only used from the event loop thread, so no locking.
+    """
+
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE, chat_burst=TELEGRAM_CHAT_BURST):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+
+    async def acquire(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                self._prune()
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+
+        delay = bucket.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        delay = self.global_bucket.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+    def _prune(self):
+        # Buckets that are full again carry no state, they are recreated on the chat's next message
+        for chat_id in [chat_id for chat_id, bucket in self.chat_buckets.items() if bucket.is_idle()]:
+            del self.chat_buckets[chat_id]
+
+
+class TelegramAPIError(Exception):
+    pass
+
+
+class AsyncTelegramClient:
+
+    def __init__(self, token, api_url=TELEGRAM_API_URL):
+        self.base_url = f'{api_url}/bot{token}'
+        self.file_url = f'{api_url}/file/bot{token}'
+        self.limiter = RateLimiter()
+        self.session = httpx.AsyncClient(
+            timeout=httpx.Timeout(30, connect=5),
+            limits=httpx.Limits(max_connections=TELEGRAM_MAX_CONNECTIONS, max_keepalive_connections=TELEGRAM_MAX_CONNECTIONS),
+        )
+
+    async def close(self):
+        await self.session.aclose()
+
+    async def call(self, method, data=None, files=None):
+        for attempt in range(TELEGRAM_MAX_RETRIES):
+            with TELEGRAM_SECONDS.labels(method).time():
+                response = await self.session.post(f'{self.base_url}/{method}', data=data, files=files)
+            result = response.json()
+            if result.get('ok'):
+                return result['result']
+            if result.get('error_code') == 429:
+                retry_after = result.get('parameters', {}).get('retry_after', 1)
+                logger.warning(f'Telegram {method} rate limited, retrying in {retry_after}s')
+                await asyncio.sleep(retry_after)
+                continue
+            raise TelegramAPIError(f"Telegram {method} failed: {result.get('description')}")
+        raise TelegramAPIError(f'Telegram {method} still rate limited after {TELEGRAM_MAX_RETRIES} attempts')
+
+    async def get_me(self):
+        return await self.call('getMe')
+
+    async def set_webhook(self, url):
+        await self.call('deleteWebhook')
+        return await self.call('setWebhook', data={'url': url})
+
+    async def download_file(self, file_id):
+        file_info = await self.call('getFile', data={'file_id': file_id})
+        with TELEGRAM_SECONDS.labels('download').time():
+            response = await self.session.get(f"{self.file_url}/{file_info['file_path']}")
+        response.raise_for_status()
+        return response.content
+
+    async def send_message(self, chat_id, text):
+        await self.limiter.acquire(chat_id)
+        return await self.call('sendMessage', data={'chat_id': chat_id, 'text': text})
+
+    async def send_photo(self, chat_id, photo_data):
+        await self.limiter.acquire(chat_id)
+        return await self.call('sendPhoto', data={'chat_id': chat_id}, files={'photo': ('photo.jpg', photo_data, 'image/jpeg')})
+
+    async def send_photos(self, chat_id, photos):
+        """Sends several photos as a single media group (album), a single photo as a plain photo"""
+        if len(photos) == 1:
+            return await self.send_photo(chat_id, photos[0])
+        await self.limiter.acquire(chat_id)
+        media = [{'type': 'photo', 'media': f'attach://photo{i}'} for i in range(len(photos))]
+        files = {f'photo{i}': (f'photo{i}.jpg', data, 'image/jpeg') for i, data in enumerate(photos)}
+        return await self.call('sendMediaGroup', data={'chat_id': chat_id, 'media': json.dumps(media)}, files=files)
@@ -0,0 +1,24 @@
+import time
+from cache import TTLCache
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_entries_expire_after_ttl():
+    cache = TTLCache(max_size=10, ttl=0.01)
+    cache.put('a', 1)
+    time.sleep(0.02)
+
+    assert cache.get('a') is None
+    assert 'a' not in cache.entries
+    assert (cache.hits, cache.misses) == (0, 1)
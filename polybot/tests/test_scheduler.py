@@ -0,0 +1,85 @@
+import threading
+import time
+from scheduler import FairScheduler
+from token_bucket import TokenBucket
+
+
+class Recorder:
+    """Dispatch target of the scheduler: records the tasks with their dispatch time, then frees the slot"""
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.dispatched = []
+        self.all_done = threading.Event()
+        self.scheduler = None
+
+    def __call__(self, task):
+        self.dispatched.append((task, time.monotonic()))
+        self.scheduler.done()
+        if len(self.dispatched) == self.expected:
+            self.all_done.set()
+
+    def tasks(self):
+        return [task for task, _ in self.dispatched]
+
+
+def make_scheduler(recorder, **kwargs):
+    scheduler = FairScheduler(recorder, **kwargs)
+    recorder.scheduler = scheduler
+    return scheduler
+
+
+def test_round_robin_across_chats():
+    recorder = Recorder(expected=7)
+    scheduler = make_scheduler(recorder, concurrency=1, chat_rate=1000, chat_burst=100)
+    for i in range(5):
+        scheduler.submit('flood', f'flood-{i}')
+    scheduler.submit('quiet', 'quiet-0')
+    scheduler.submit('quiet', 'quiet-1')
+
+    scheduler.start()
+    assert recorder.all_done.wait(timeout=5)
+    assert recorder.tasks() == ['flood-0', 'quiet-0', 'flood-1', 'quiet-1', 'flood-2', 'flood-3', 'flood-4']
+
+
+def test_chat_over_its_rate_does_not_delay_other_chats():
+    rate, burst = 5, 2
+    recorder = Recorder(expected=7)
+    scheduler = make_scheduler(recorder, concurrency=4, chat_rate=rate, chat_burst=burst)
+    for i in range(6):
+        scheduler.submit('flood', f'flood-{i}')
+    started = time.monotonic()
+    scheduler.start()
+    time.sleep(0.05)
+    scheduler.submit('quiet', 'quiet-0')
+    assert recorder.all_done.wait(timeout=5)
+
+    times = dict(recorder.dispatched)
+    # The burst goes out at once, the rest of the flood at the chat's rate
+    assert times['flood-1'] - started < 0.1
+    assert times['flood-5'] - started >= (6 - burst) / rate * 0.9
+    # The other chat is served right away, ahead of the throttled flood
+    assert times['quiet-0'] - started < 0.2
+    assert recorder.tasks().index('quiet-0') < recorder.tasks().index('flood-3')
+
+
+def test_tasks_over_max_pending_are_refused():
+    scheduler = FairScheduler(lambda task: None, concurrency=1, max_pending=2)
+    assert scheduler.submit('chat', 'a')
+    assert scheduler.submit('chat', 'b')
+    assert not scheduler.submit('chat', 'c')
+    # Other chats have their own limit
+    assert scheduler.submit('other', 'a')
+
+
+def test_album_cost_is_taken_from_the_bucket_at_once():
+    bucket = TokenBucket(rate=1, capacity=10)
+    assert bucket.try_take(10)
+    assert not bucket.try_take(1)
+    assert 0.9 < bucket.wait_time(1) <= 1
+
+
+def test_cost_over_capacity_is_capped():
+    bucket = TokenBucket(rate=1, capacity=3)
+    assert bucket.try_take(5)
+    assert bucket.wait_time(5) > 2.9
@@ -0,0 +1,46 @@
+"""
+Token bucket used by the Telegram rate limiter (telegram_api.py) and the per-chat scheduler (scheduler.py).
+Not thread safe by itself, callers hold their own lock or stay on one thread.
+"""
+import time
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """
+        Takes a token, going into debt when the bucket is empty
+        :return: number of seconds the caller has to wait before using its token
+        """
+        self._refill()
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def try_take(self, cost=1):
+        """Takes `cost` tokens (at most the bucket's capacity) if they are available, without going into debt"""
+        self._refill()
+        cost = min(cost, self.capacity)
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+    def wait_time(self, cost=1):
+        """:return: number of seconds until `cost` tokens are available"""
+        self._refill()
+        return max(0, min(cost, self.capacity) - self.tokens) / self.rate
+
+    def is_idle(self):
+        self._refill()
+        return self.tokens >= self.capacity
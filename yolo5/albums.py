@@ -0,0 +1,40 @@
+"""
+Album jobs: polybot sends the photos of a Telegram album as a single SQS message. The worker splits
+it into one job per photo (so the photos are downloaded in parallel and land in the same inference
+micro-batch), and the AlbumTracker gathers them again, so the album is answered with a single
+callback and its message deleted once every photo is stored.
+"""
+import threading
+import time
+
+
+class AlbumTracker:
+
+    def __init__(self, max_age=900):
+        # Albums that lost a photo to a failure are retried as a whole, their partial state is dropped after max_age seconds
+        self.max_age = max_age
+        # album id -> (first photo done time, {index: job})
+        self.albums = {}
+        self.lock = threading.Lock()
+
+    def add(self, job):
+        """
+        Records a stored photo of an album
+        :return: the jobs of all the album's photos in album order once the last one is stored, else None
+        """
+        album = job['album']
+        now = time.time()
+        with self.lock:
+            for album_id in [album_id for album_id, (started, _) in self.albums.items() if now - started > self.max_age]:
+                del self.albums[album_id]
+
+            _, parts = self.albums.setdefault(album['id'], (now, {}))
+            parts[album['index']] = job
+            if len(parts) < album['size']:
+                return None
+            del self.albums[album['id']]
+        return [parts[index] for index in sorted(parts)]
+
+    def discard(self, job):
+        with self.lock:
+            self.albums.pop(job['album']['id'], None)
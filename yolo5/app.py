@@ -1,152 +1,413 @@
 import time
-from pathlib import Path
 from flask import Flask, request
-from detect import run
 import uuid
-from pymongo import MongoClient
-import yaml
-import boto3
-from botocore.exceptions import NoCredentialsError
+import cv2
+import numpy as np
 from loguru import logger
 import os
 import json
-import requests
+import signal
+import threading
+from clients import get_s3_client, get_sqs_client, get_http_session
+from detector import Detector
+from pipeline import Stage, BatchStage
+from pymongo.errors import OperationFailure
+from store import PredictionWriter, ensure_indexes, find_stored_prediction
+from lease import LeaseManager, MessageDeleter
+from albums import AlbumTracker
+from workspace import get_workspace
+from cache import prediction_cache, content_key
+from metrics import (QUEUE_LAG_SECONDS, S3_SECONDS, MODEL_LOAD_SECONDS, WARMUP_SECONDS, INFERENCE_SECONDS,
+                     INFERENCE_BATCH_SIZE, CALLBACK_SECONDS, PREDICTIONS, RECEIVE_FAILURES)
+from health import start_admin_server, ready
+from functools import partial
 
 BUCKET_NAME = os.environ['BUCKET_NAME']
 SQS_URL = os.environ['SQS_URL']
+# polybot's service inside the cluster, prediction results are posted to its /results route
+POLYBOT_URL = os.environ.get('POLYBOT_URL', 'http://svc-polybot:8443')
+# Shared secret sent in the X-Callback-Token header, polybot only trusts the summary in the callback body with it
+CALLBACK_TOKEN = os.environ.get('CALLBACK_TOKEN')
+# (connect, read) timeouts of the callback, a hanging polybot fails the notify stage instead of blocking its threads
+CALLBACK_TIMEOUT = (float(os.environ.get('CALLBACK_CONNECT_TIMEOUT', '3')), float(os.environ.get('CALLBACK_READ_TIMEOUT', '10')))
 
-sqs_client = boto3.client('sqs', region_name='eu-north-1')
+# Inference backend (pytorch, onnx or int8, see backends.py) and its model file, the backend's default file when unset
+INFERENCE_BACKEND = os.environ.get('INFERENCE_BACKEND', 'pytorch')
+YOLO_WEIGHTS = os.environ.get('YOLO_WEIGHTS')
+# Inference image size, images are letterboxed to IMG_SIZE x IMG_SIZE and the boxes mapped back to the original image.
+# The TorchScript model of the Docker image is exported for one size, see the Dockerfile's IMG_SIZE build arg
+IMG_SIZE = int(os.environ.get('IMG_SIZE', '640'))
+# Intra-op threads of the inference backend, 0 keeps the library default (one per core)
+INFERENCE_THREADS = int(os.environ.get('INFERENCE_THREADS', '0'))
+# Micro-batching: up to BATCH_MAX_SIZE images are inferred together, waiting at most BATCH_MAX_WAIT seconds to fill the batch
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', '10'))
+BATCH_MAX_WAIT = float(os.environ.get('BATCH_MAX_WAIT', '0.05'))
+# Number of threads of every I/O stage, and the size of the bounded queue in front of each stage
+DOWNLOAD_CONCURRENCY = int(os.environ.get('DOWNLOAD_CONCURRENCY', '4'))
+UPLOAD_CONCURRENCY = int(os.environ.get('UPLOAD_CONCURRENCY', '4'))
+NOTIFY_CONCURRENCY = int(os.environ.get('NOTIFY_CONCURRENCY', '4'))
+STAGE_QUEUE_SIZE = int(os.environ.get('STAGE_QUEUE_SIZE', '20'))
+# Prediction summaries are inserted to MongoDB in bulk, by MONGO_BATCH_SIZE or every MONGO_FLUSH_INTERVAL seconds
+MONGO_BATCH_SIZE = int(os.environ.get('MONGO_BATCH_SIZE', '50'))
+MONGO_FLUSH_INTERVAL = float(os.environ.get('MONGO_FLUSH_INTERVAL', '0.2'))
 
-with open("data/coco128.yaml", "r") as stream:
-    names = yaml.safe_load(stream)['names']
+# How results reach the user: `annotated` uploads an annotated copy of the image to S3, `boxes` only stores the
+# detections and polybot draws them on the original photo it still has, saving the encode and an S3 round-trip
+RESULT_DELIVERY = os.environ.get('RESULT_DELIVERY', 'annotated')
+if RESULT_DELIVERY not in ('annotated', 'boxes'):
+    raise RuntimeError(f'RESULT_DELIVERY must be annotated or boxes, not {RESULT_DELIVERY}')
+
+# SQS returns at most 10 messages per receive_message call
+SQS_MAX_MESSAGES = 10
+# Messages are received with a short visibility timeout, which is extended every LEASE_HEARTBEAT_INTERVAL seconds
+# while they are processed, for LEASE_MAX_SECONDS at most (see lease.py)
+SQS_VISIBILITY_TIMEOUT = int(os.environ.get('SQS_VISIBILITY_TIMEOUT', '60'))
+LEASE_HEARTBEAT_INTERVAL = float(os.environ.get('LEASE_HEARTBEAT_INTERVAL', '20'))
+LEASE_MAX_SECONDS = float(os.environ.get('LEASE_MAX_SECONDS', '900'))
+# Longest pause of the consumer loop after consecutive receive_message failures
+RECEIVE_MAX_BACKOFF = 30
+# On SIGTERM the worker stops receiving and waits this long for its in-flight jobs, keep it below
+# the terminationGracePeriodSeconds of the pod
+SHUTDOWN_TIMEOUT = float(os.environ.get('SHUTDOWN_TIMEOUT', '60'))
+
+
+def parse_message(message):
+    """
+    Parses an SQS message into the job dicts that flow through the pipeline stages: a single job, or
+    one job per photo of an album, all sharing the message's receipt handle (see albums.py).
+    """
+    # Use the MessageId as a prediction UUID
+    prediction_id = message['MessageId']
+
+    # Extract the message from the SQS message and CHAT_ID
+    body = json.loads(message['Body'])
+    img_names = body["imgNames"] if "imgNames" in body else [body["imgName"]]
+    img_name = img_names[0]
+    chat_id = img_name.split("_")[0]
+
+    # Trace context set by polybot, it follows the prediction up to the /results callback
+    trace = body.get('trace') or {'trace_id': prediction_id}
+    if 'enqueued_at' in trace:
+        QUEUE_LAG_SECONDS.observe(max(0, time.time() - trace['enqueued_at']))
+    logger.info(f'prediction: {prediction_id}. trace: {trace["trace_id"]}. start processing')
+
+    job = {
+        'prediction_id': prediction_id,
+        # You must use this ReceiptHandle to delete the message after processing it, preventing it from being processed again.
+        'receipt_handle': message['ReceiptHandle'],
+        'img_name': img_name,
+        'chat_id': chat_id,
+        # Prediction cache keys computed by polybot (content hash and Telegram file_unique_id)
+        'cache_keys': body.get('cacheKeys', []),
+        'trace': trace,
+        # Above 1 when the message was received before, and that attempt may have stored its prediction already
+        'receive_count': int(message.get('Attributes', {}).get('ApproximateReceiveCount', '1')),
+    }
+    if "imgNames" not in body:
+        return [job]
+
+    cache_keys = body.get('cacheKeys') or [[] for _ in img_names]
+    return [{
+        **job,
+        'prediction_id': f'{prediction_id}-{index}',
+        'img_name': name,
+        'cache_keys': list(keys),
+        'album': {'id': prediction_id, 'index': index, 'size': len(img_names)},
+    } for index, (name, keys) in enumerate(zip(img_names, cache_keys))]
+
+
+def use_cached_prediction(job, cached):
+    """Fills the job with a cached result, so it can skip inference and the upload"""
+    logger.info(f'prediction: {job["prediction_id"]}. prediction cache hit, reusing {cached["prediction_id"]}')
+    job['labels'] = cached['labels']
+    job['predicted_img_path'] = cached.get('predicted_img_path')
+    job['cached'] = True
+    return job
+
+
+def use_stored_prediction(job, stored):
+    """Fills a redelivered job with the prediction an earlier attempt already stored"""
+    logger.info(f'prediction: {job["prediction_id"]}. redelivered message, its prediction is already stored')
+    job['labels'] = stored['labels']
+    job['predicted_img_path'] = stored.get('predicted_img_path')
+    job['cached'] = True
+    job['redelivered'] = True
+    return job
+
+
+def download_image(s3_client, persist_stage, deleter, job):
+    """
+    Download stage: fetches the image polybot has uploaded to S3 and decodes it straight from memory.
+    Images already in the prediction cache, and redelivered messages whose prediction is already
+    stored, go directly to the persist stage, whose upsert makes storing them again a no-op.
+    """
+    prediction_id = job['prediction_id']
+    img_name = job['img_name']
+
+    if job['receive_count'] > 1:
+        stored = find_stored_prediction(prediction_id)
+        if stored:
+            persist_stage.put(use_stored_prediction(job, stored))
+            return None
+
+    cached = prediction_cache.get(*job['cache_keys']) if job['cache_keys'] else None
+    if cached:
+        persist_stage.put(use_cached_prediction(job, cached))
+        return None
+
+    with S3_SECONDS.labels('download').time():
+        data = s3_client.get_object(Bucket=BUCKET_NAME, Key=img_name)['Body'].read()
+    logger.info(f'prediction: {prediction_id}. Downloaded {img_name} ({len(data)} bytes)')
+
+    img_content_key = content_key(data)
+    if img_content_key not in job['cache_keys']:
+        job['cache_keys'].append(img_content_key)
+        cached = prediction_cache.get(img_content_key)
+        if cached:
+            persist_stage.put(use_cached_prediction(job, cached))
+            return None
+
+    job['img'] = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if job['img'] is None:
+        logger.error(f'prediction: {prediction_id}/{img_name}. could not decode image')
+        # Kept for debugging, within the workspace budget
+        get_workspace().keep(f'undecodable-{img_name}', data)
+        if job.get('album'):
+            # The rest of the album is still answered, this photo without any object
+            job.update(labels=[], error='could not decode image')
+            persist_stage.put(job)
+            return None
+        # Delete the message from the queue, the image can't be processed anyway
+        deleter.delete(job)
+        return None
+    return job
+
+
+def infer(detector, jobs):
+    """Inference stage: predicts the objects of a whole micro-batch in a single forward pass."""
+    INFERENCE_BATCH_SIZE.observe(len(jobs))
+    with INFERENCE_SECONDS.time():
+        batch_labels = detector.predict_batch([job['img'] for job in jobs])
+    logger.info(f'batch of {len(jobs)} predictions done')
+
+    for job, labels in zip(jobs, batch_labels):
+        job['labels'] = labels
+    return jobs
+
+
+def upload_prediction(detector, s3_client, job):
+    """Upload stage: draws the detections on the image, encodes it to JPEG in memory and uploads it to S3."""
+    prediction_id = job['prediction_id']
+
+    # The predicted image includes bounding boxes drawn around the detected objects, along with class labels and confidence scores.
+    ok, encoded = cv2.imencode('.jpg', detector.annotate(job['img'], job['labels']))
+    if not ok:
+        raise RuntimeError(f'prediction: {prediction_id}. could not encode the predicted image')
+
+    # Upload predicted image back to S3, a failure is handled by the stage like any other (the message is kept)
+    s3_image_key_upload = f'predictions/{job["img_name"]}'
+    with S3_SECONDS.labels('upload').time():
+        s3_client.put_object(Bucket=BUCKET_NAME, Key=s3_image_key_upload, Body=encoded.tobytes(), ContentType='image/jpeg')
+    logger.info(f"File uploaded successfully to {BUCKET_NAME}/{s3_image_key_upload}")
+
+    job['predicted_img_path'] = s3_image_key_upload
+    return job
+
+
+def persist_prediction(writer, job):
+    """Persist stage: hands the prediction summary to the MongoDB write buffer."""
+    prediction_id = job['prediction_id']
+    # The decoded image is not needed anymore, don't keep it in memory until the bulk insert
+    job.pop('img', None)
+    logger.info(f'prediction: {prediction_id}/{job["img_name"]}. prediction summary:\n\n{job["labels"]}')
+
+    # Both image paths are S3 keys in BUCKET_NAME, nothing is kept on the worker's disk
+    prediction_summary = {
+        'prediction_id': prediction_id,
+        'original_img_path': job['img_name'],
+        'predicted_img_path': job.get('predicted_img_path'),
+        'labels': job['labels'],
+        'chat_id': job['chat_id'],
+        'trace': job['trace'],
+        'time': time.time()
+    }
+    if job.get('album'):
+        prediction_summary['album_id'] = job['album']['id']
+        prediction_summary['album_index'] = job['album']['index']
+    if job.get('error'):
+        prediction_summary['error'] = job['error']
+    if not job.get('cached') and not job.get('error'):
+        prediction_cache.put(job['cache_keys'], {
+            'prediction_id': prediction_id,
+            'labels': job['labels'],
+            'original_img_path': job['img_name'],
+            'predicted_img_path': job.get('predicted_img_path'),
+        })
+    writer.add(prediction_summary, job)
+
+
+def callback_summary(job):
+    summary = {
+        'prediction_id': job['prediction_id'],
+        'chat_id': job['chat_id'],
+        'labels': job['labels'],
+        'original_img_path': job['img_name'],
+        'predicted_img_path': job.get('predicted_img_path'),
+        'trace': job['trace'],
+    }
+    if job.get('error'):
+        summary['error'] = job['error']
+    return summary
+
+
+def notify_polybot(deleter, albums, job):
+    """
+    Notify stage: runs once the summary is stored in MongoDB, notifies polybot and then deletes the SQS message.
+    The photos of an album wait for each other, the album is answered by a single callback.
+    """
+    jobs = [job]
+    prediction_id = job['prediction_id']
+    # Notify polybot that the prediction is done, the compact summary is sent along so polybot doesn't have to read it back from MongoDB
+    summary = callback_summary(job)
+    if job.get('album'):
+        jobs = albums.add(job)
+        if jobs is None:
+            return
+        prediction_id = job['album']['id']
+        summary = {
+            'prediction_id': prediction_id,
+            'chat_id': job['chat_id'],
+            'album': [callback_summary(part) for part in jobs],
+            'trace': job['trace'],
+        }
+
+    with CALLBACK_SECONDS.time():
+        headers = {'X-Callback-Token': CALLBACK_TOKEN} if CALLBACK_TOKEN else None
+        response = get_http_session().post(f'{POLYBOT_URL}/results?predictionId={prediction_id}', json=summary, headers=headers,
+                                          timeout=CALLBACK_TIMEOUT)
+    # A failed callback fails the stage, the message is kept and redelivered, and its stored prediction is sent again
+    response.raise_for_status()
+
+    # Delete the message from the queue as the job is considered as DONE, batched with the messages of other jobs
+    deleter.delete(job)
+    for done in jobs:
+        PREDICTIONS.labels('redelivery' if done.get('redelivered') else 'cache' if done.get('cached') else 'model').inc()
+
+
+def drop_job(leases, albums, job):
+    """Failure handler of the stages: the message is kept and will be redelivered, stop extending its lease"""
+    if job.get('album'):
+        # The whole album is retried, the photos already stored are skipped then (see download_image)
+        albums.discard(job)
+    leases.release(job)
 
 
 def consume():
-    while True:
-        response = sqs_client.receive_message(QueueUrl=SQS_URL, MaxNumberOfMessages=1, WaitTimeSeconds=5)
-
-        if 'Messages' in response:
-            message = response['Messages'][0]['Body']
-            # You must use this ReceiptHandle to delete the message after processing it, preventing it from being processed again.
-            receipt_handle = response['Messages'][0]['ReceiptHandle']
-
-            # Use the ReceiptHandle as a prediction UUID
-            prediction_id = response['Messages'][0]['MessageId']
-
-            logger.info(f'prediction: {prediction_id}. start processing')
-
-            # Extract the message from the SQS message and CHAT_ID
-            message = json.loads(message)
-            img_name = message["imgName"]
-            chat_id = img_name.split("_")[0]
-            original_img_path = f'/tmp/{chat_id}_{img_name}'  # Temporary storage for downloaded image
-            
-            # Initialize the S3 client
-            s3_client = boto3.client('s3')
-            # Download the image from S3 that polybot has uploaded
-            try:
-                # Download the file from S3
-                s3_client.download_file(BUCKET_NAME, img_name, original_img_path)
-                logger.info(f'prediction: {prediction_id}. Downloaded {img_name} to {original_img_path}')
-                logger.info(f'prediction: {prediction_id}/{original_img_path}. Download img completed')
-            except Exception as e:
-                logger.error(f'Error downloading {img_name}: {e}')
-
-            # Predicts the objects in the image
-            run(
-                weights='yolov5s.pt',
-                data='data/coco128.yaml',
-                source=original_img_path,
-                project='static/data',
-                name=prediction_id,
-                save_txt=True
-            )
-
-            logger.info(f'prediction: {prediction_id}/{original_img_path}. done')
-
-            # This is the path for the predicted image with labels
-            # The predicted image typically includes bounding boxes drawn around the detected objects, along with class labels and possibly confidence scores.
-            predicted_img_name = os.path.basename(original_img_path)  # Extracts the image file without /tmp/ "exmaple 7893093742_7893093742_teleBOT_picture.jpg"
-            predicted_img_path = f'static/data/{prediction_id}/{predicted_img_name}'
-
-            # predict the image and upload it to S3
-            s3_image_key_upload = f'predictions/{img_name}'
+    # Liveness is served right away, readiness only once the worker polls SQS
+    start_admin_server()
+
+    # Load the model once for the whole lifetime of the worker
+    load_start = time.time()
+    detector = Detector(weights=YOLO_WEIGHTS, data='data/coco128.yaml', imgsz=IMG_SIZE,
+                        backend=INFERENCE_BACKEND, threads=INFERENCE_THREADS)
+    load_seconds = time.time() - load_start
+    MODEL_LOAD_SECONDS.set(load_seconds)
+
+    # Pay the cost of the first forward passes before the worker reports ready
+    warmup_start = time.time()
+    detector.warmup(batch_size=BATCH_MAX_SIZE)
+    warmup_seconds = time.time() - warmup_start
+    WARMUP_SECONDS.set(warmup_seconds)
+    logger.info(f'{INFERENCE_BACKEND} model loaded in {load_seconds:.1f}s, warmed up in {warmup_seconds:.1f}s')
+
+    # boto3 clients are thread safe, so all the stages share the pooled S3 client
+    s3_client = get_s3_client()
+    sqs_client = get_sqs_client()
+    try:
+        ensure_indexes()
+    except OperationFailure as e:
+        # Usually duplicate prediction ids stored before the upserts, run migrate.py once to remove them.
+        # The worker runs without the index meanwhile, its upserts don't depend on it.
+        logger.error(f'Could not create the MongoDB indexes, run migrate.py: {e}')
+
+    # Every received message holds a lease until it's deleted, or its job fails in a stage (it's then redelivered)
+    leases = LeaseManager(sqs_client, SQS_URL, visibility_timeout=SQS_VISIBILITY_TIMEOUT,
+                          heartbeat_interval=LEASE_HEARTBEAT_INTERVAL, max_lease=LEASE_MAX_SECONDS)
+    deleter = MessageDeleter(sqs_client, SQS_URL, leases)
+    albums = AlbumTracker(max_age=LEASE_MAX_SECONDS)
+    on_failure = partial(drop_job, leases, albums)
+
+    # download (thread pool) -> inference (dedicated thread, micro-batches) -> upload (thread pool, `annotated` delivery only)
+    # -> persist -> bulk upsert to MongoDB (write buffer) -> notify (thread pool)
+    notify_stage = Stage('notify', partial(notify_polybot, deleter, albums), concurrency=NOTIFY_CONCURRENCY,
+                         maxsize=STAGE_QUEUE_SIZE, on_failure=on_failure)
+    writer = PredictionWriter(on_flush=notify_stage.put, max_size=MONGO_BATCH_SIZE, max_delay=MONGO_FLUSH_INTERVAL,
+                              on_failure=on_failure)
+    persist_stage = Stage('persist', partial(persist_prediction, writer), maxsize=STAGE_QUEUE_SIZE, on_failure=on_failure)
+    stages = [notify_stage, persist_stage]
+    after_inference = persist_stage
+    if RESULT_DELIVERY == 'annotated':
+        after_inference = Stage('upload', partial(upload_prediction, detector, s3_client), concurrency=UPLOAD_CONCURRENCY,
+                                maxsize=STAGE_QUEUE_SIZE, next_stage=persist_stage, on_failure=on_failure)
+        stages.append(after_inference)
+    inference_stage = BatchStage('inference', partial(infer, detector), max_batch_size=BATCH_MAX_SIZE,
+                                 max_wait=BATCH_MAX_WAIT, maxsize=STAGE_QUEUE_SIZE, next_stage=after_inference,
+                                 on_failure=on_failure)
+    download_stage = Stage('download', partial(download_image, s3_client, persist_stage, deleter), concurrency=DOWNLOAD_CONCURRENCY,
+                           maxsize=STAGE_QUEUE_SIZE, next_stage=inference_stage, on_failure=on_failure)
+    stages += [inference_stage, download_stage]
+
+    leases.start()
+    deleter.start()
+    writer.start()
+    for stage in stages:
+        stage.start()
+    logger.info(f'Pipeline started, {RESULT_DELIVERY} result delivery')
+    ready.set()
+
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        logger.info('SIGTERM received, no longer receiving messages')
+        ready.clear()
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+
+    backoff = 1
+    while not stopping.is_set():
+        try:
+            response = sqs_client.receive_message(QueueUrl=SQS_URL, MaxNumberOfMessages=SQS_MAX_MESSAGES, WaitTimeSeconds=5,
+                                                  VisibilityTimeout=SQS_VISIBILITY_TIMEOUT,
+                                                  AttributeNames=['ApproximateReceiveCount'])
+            backoff = 1
+        except Exception as e:
+            # A failing receive (throttling, network, credentials rotation) must not end the worker
+            RECEIVE_FAILURES.labels('receive').inc()
+            logger.exception(f'Error receiving messages from SQS, retrying in {backoff}s: {e}')
+            time.sleep(backoff)
+            backoff = min(backoff * 2, RECEIVE_MAX_BACKOFF)
+            continue
+
+        for message in response.get('Messages', []):
             try:
-                # Upload predicted image back to S3
-                s3_client.upload_file(predicted_img_path, BUCKET_NAME, s3_image_key_upload)
-                logger.info(f"File uploaded successfully to {BUCKET_NAME}/{s3_image_key_upload}")
-            except FileNotFoundError:
-                logger.error("The file was not found.")
-                return "Predicted image not found", 404
-            except NoCredentialsError:
-                logger.error("AWS credentials not available to S3.")
-                return "AWS credentials not available to S3", 403
+                jobs = parse_message(message)
             except Exception as e:
-                logger.error(f"Error uploading file: {e}")
-                return f"Error uploading file: {e}", 500
-
-            # Parse prediction labels and create a summary
-            pred_summary_path = Path(f'static/data/{prediction_id}/labels/{predicted_img_name.split(".")[0]}.txt')
-            if pred_summary_path.exists():
-                with open(pred_summary_path) as f:
-                    labels = f.read().splitlines()
-                    labels = [line.split(' ') for line in labels]
-                    labels = [{
-                        'class': names[int(l[0])],
-                        'cx': float(l[1]),
-                        'cy': float(l[2]),
-                        'width': float(l[3]),
-                        'height': float(l[4]),
-                    } for l in labels]
-
-                logger.info(f'prediction: {prediction_id}/{original_img_path}. prediction summary:\n\n{labels}')
-
-                prediction_summary = {
-                    'prediction_id': prediction_id,
-                    'original_img_path': original_img_path,
-                    'predicted_img_path': predicted_img_path,
-                    'labels': labels,
-                    'chat_id': chat_id,
-                    'time': time.time()
-                }
-
-                try:
-                    # Connect to MongoDB
-                    # If your MongoDB is deployed as a StatefulSet with a headless service (which is typical), you might be able to just use the service name
-                    mongo_client = MongoClient('mongodb://mongodb.default.svc.cluster.local:27017/?replicaSet=rs0')
-                    logger.info("Connected to MongoDB")
-                except Exception as e:
-                    logger.error(f"Error connecting to MongoDB: {e}")
-                try:
-                    # Select the database (polybot-info) and collection (prediction_images)
-                    db = mongo_client['polybot-info']
-                    collection = db['prediction_images']
-                    # Insert the prediction_summary into MongoDB
-                    collection.insert_one(prediction_summary)
-                    print("Prediction summary inserted successfully.")
-                    if "_id" in prediction_summary:
-                        prediction_summary["_id"] = str(prediction_summary["_id"])
-                    logger.info(f"Prediction summary inserted successfully: {prediction_summary}")
-                except Exception as e:
-                    logger.error(f"Error inserting prediction summary to MongoDB: {e}")
-                
-                # Delete the message from the queue as the job is considered as DONE
-                sqs_client.delete_message(QueueUrl=SQS_URL, ReceiptHandle=receipt_handle)
-                
-                # Notify polybot that the prediction is done
-                requests.post(f'http://svc-polybot:8443/results?predictionId={prediction_id}')
-
-                
-                return prediction_summary
-                
-                
-            else:
-                # Delete the message from the queue as the job is considered as DONE
-                sqs_client.delete_message(QueueUrl=SQS_URL, ReceiptHandle=receipt_handle)
-                logger.error(f'prediction: {prediction_id}/{original_img_path}. prediction result not found')
-                return f'prediction: {prediction_id}/{original_img_path}. prediction result not found', 404
-            
-       
-                       
+                # Left in the queue, a message that never parses ends up in the dead-letter queue
+                RECEIVE_FAILURES.labels('parse').inc()
+                logger.exception(f'message: {message.get("MessageId")}. could not parse message: {e}')
+                continue
+            leases.acquire(jobs[0])
+            # Blocks when the download queue is full, so the worker never holds more messages than it can process
+            for job in jobs:
+                download_stage.put(job)
+
+    # A message is released once deleted or dropped, so no lease left means the stages are drained
+    held = leases.wait_released(SHUTDOWN_TIMEOUT)
+    if held:
+        logger.warning(f'Shutting down with {held} messages in flight, SQS redelivers them')
+    else:
+        logger.info('In-flight jobs finished, shutting down')
+
 if __name__ == "__main__":
     consume()
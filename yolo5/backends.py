@@ -0,0 +1,77 @@
+"""
+Inference backends of the yolo5 worker, selected by INFERENCE_BACKEND:
+
+    pytorch   FP32 PyTorch model, TorchScript (yolov5s.torchscript) when it was exported, else yolov5s.pt
+    onnx      FP32 ONNX model run by ONNX Runtime (yolov5s.onnx)
+    int8      ONNX model with dynamically quantized int8 weights (yolov5s-int8.onnx)
+
+Every backend is called with a normalized NCHW float tensor and returns the raw predictions that
+go into non_max_suppression, so the Detector does not depend on which one is used.
+The Docker image builds all the model files, see the Dockerfile.
+"""
+import ast
+import os
+import numpy as np
+import torch
+import yaml
+from loguru import logger
+from models.common import DetectMultiBackend
+
+BACKENDS = ('pytorch', 'onnx', 'int8')
+
+DEFAULT_WEIGHTS = {
+    'pytorch': 'yolov5s.torchscript' if os.path.exists('yolov5s.torchscript') else 'yolov5s.pt',
+    'onnx': 'yolov5s.onnx',
+    'int8': 'yolov5s-int8.onnx',
+}
+
+
+class OnnxBackend:
+    """
+    ONNX Runtime session on the CPU, with its own thread settings.
+    Exposes the same `names`, `stride` and `fp16` attributes as yolov5's DetectMultiBackend.
+    """
+
+    def __init__(self, weights, data=None, threads=0):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        # 0 lets ONNX Runtime use one thread per physical core
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(weights, sess_options=options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.fp16 = False
+
+        # yolov5's export.py stores the stride and class names in the model metadata
+        meta = self.session.get_modelmeta().custom_metadata_map
+        self.stride = int(meta.get('stride', 32))
+        if 'names' in meta:
+            self.names = ast.literal_eval(meta['names'])
+        else:
+            with open(data) as f:
+                self.names = yaml.safe_load(f)['names']
+
+    def __call__(self, im):
+        pred = self.session.run(None, {self.input_name: im.cpu().numpy().astype(np.float32)})[0]
+        return torch.from_numpy(pred)
+
+
+def load_backend(backend, weights=None, data=None, device=None, threads=0):
+    """
+    :param backend: one of BACKENDS
+    :param weights: model file, the backend's default when not given
+    :param threads: intra-op threads of the backend, 0 keeps the library default
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown inference backend {backend}, expected one of {", ".join(BACKENDS)}')
+    weights = weights or DEFAULT_WEIGHTS[backend]
+    logger.info(f'Loading {backend} backend from {weights}, {threads or "default"} intra-op threads')
+
+    if backend == 'pytorch':
+        if threads:
+            torch.set_num_threads(threads)
+        return DetectMultiBackend(weights, device=device, data=data)
+    return OnnxBackend(weights, data=data, threads=threads)
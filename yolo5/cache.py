@@ -0,0 +1,128 @@
+"""
+Content-addressed cache of prediction results.
+
+Results are keyed on the SHA-256 of the image bytes (and on Telegram's `file_unique_id`, when
+polybot passes it along with the job), so identical images that reach the worker skip inference and
+the upload of another annotated copy. A bounded in-process LRU sits in front of the
+`polybot-info.prediction_cache` collection, whose entries expire through a TTL index.
+"""
+import datetime
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from loguru import logger
+from pymongo import UpdateOne
+from clients import get_mongo_client
+
+PREDICTION_CACHE_TTL = int(os.environ.get('PREDICTION_CACHE_TTL', str(7 * 24 * 3600)))
+PREDICTION_CACHE_SIZE = int(os.environ.get('PREDICTION_CACHE_SIZE', '10000'))
+
+
+def content_key(data):
+    return f'sha256:{hashlib.sha256(data).hexdigest()}'
+
+
+def file_key(file_unique_id):
+    return f'file:{file_unique_id}'
+
+
+class TTLCache:
+    """Thread safe LRU whose entries also expire `ttl` seconds after they were stored"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+class PredictionCache:
+    """
+    Cached values are dicts with the `prediction_id`, `labels`, `original_img_path` and
+    `predicted_img_path` of the prediction that first processed the image. Cache failures are
+    logged and treated as misses, they never fail the photo itself.
+    """
+
+    def __init__(self, max_size=PREDICTION_CACHE_SIZE, ttl=PREDICTION_CACHE_TTL):
+        self.ttl = ttl
+        self.local = TTLCache(max_size, ttl)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def collection(self):
+        return get_mongo_client()['polybot-info']['prediction_cache']
+
+    def ensure_indexes(self):
+        self.collection().create_index('created_at', expireAfterSeconds=self.ttl, name='created_at_ttl')
+
+    def _count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, *keys):
+        for key in keys:
+            value = self.local.get(key)
+            if value is not None:
+                self._count(hit=True)
+                return value
+
+        try:
+            document = self.collection().find_one({'_id': {'$in': list(keys)}})
+        except Exception as e:
+            logger.error(f'Error reading the prediction cache: {e}')
+            document = None
+
+        # Mongo's TTL monitor only runs once a minute, so expired documents may still be returned
+        expires = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.ttl)
+        if document is None or document['created_at'] < expires:
+            self._count(hit=False)
+            return None
+
+        value = {field: document.get(field) for field in ('prediction_id', 'labels', 'original_img_path', 'predicted_img_path')}
+        for key in keys:
+            self.local.put(key, value)
+        self._count(hit=True)
+        return value
+
+    def put(self, keys, value):
+        for key in keys:
+            self.local.put(key, value)
+        fields = {**value, 'created_at': datetime.datetime.utcnow()}
+        try:
+            self.collection().bulk_write([UpdateOne({'_id': key}, {'$set': fields}, upsert=True) for key in keys], ordered=False)
+        except Exception as e:
+            logger.error(f'Error writing the prediction cache: {e}')
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'local_hits': self.local.hits, 'local_size': len(self.local.entries)}
+
+
+prediction_cache = PredictionCache()
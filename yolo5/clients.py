@@ -0,0 +1,66 @@
+"""
+Process-wide registry of the S3, SQS, MongoDB and HTTP clients.
+
+Every client is created lazily on first use and then shared by all threads of the process, so
+connection pools, TLS sessions and the MongoDB replica-set discovery are paid for once per pod
+instead of once per message.
+"""
+import os
+import threading
+import boto3
+import requests
+from botocore.config import Config
+from pymongo import MongoClient
+from requests.adapters import HTTPAdapter
+
+SQS_REGION = os.environ.get('SQS_REGION', 'eu-north-1')
+MONGO_URI = os.environ.get('MONGO_URI', 'mongodb://mongodb.default.svc.cluster.local:27017/?replicaSet=rs0')
+# Upper bound of open connections per client, should cover the concurrency of the pipeline stages
+CLIENT_POOL_SIZE = int(os.environ.get('CLIENT_POOL_SIZE', '32'))
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def _get_or_create(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            # Another thread may have created it while we were waiting for the lock
+            client = _clients.get(name)
+            if client is None:
+                client = factory()
+                _clients[name] = client
+    return client
+
+
+def _boto_config():
+    return Config(
+        max_pool_connections=CLIENT_POOL_SIZE,
+        tcp_keepalive=True,
+        retries={'max_attempts': 5, 'mode': 'adaptive'},
+    )
+
+
+def get_s3_client():
+    return _get_or_create('s3', lambda: boto3.client('s3', config=_boto_config()))
+
+
+def get_sqs_client():
+    return _get_or_create('sqs', lambda: boto3.client('sqs', region_name=SQS_REGION, config=_boto_config()))
+
+
+def get_mongo_client():
+    # If your MongoDB is deployed as a StatefulSet with a headless service (which is typical), you might be able to just use the service name
+    return _get_or_create('mongo', lambda: MongoClient(MONGO_URI, maxPoolSize=CLIENT_POOL_SIZE, connect=False))
+
+
+def get_http_session():
+    def create_session():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=CLIENT_POOL_SIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    return _get_or_create('http', create_session)
@@ -0,0 +1,104 @@
+"""
+In-process YOLOv5 detector.
+
+The model is loaded a single time when the worker starts, and predictions run on images that are
+already decoded in memory, instead of going through `detect.run()` (weights, yaml, dataloader)
+for every SQS message.
+"""
+import numpy as np
+import torch
+from loguru import logger
+from utils.augmentations import letterbox
+from utils.general import check_img_size, non_max_suppression, scale_boxes
+from utils.plots import Annotator, colors
+from utils.torch_utils import select_device
+from backends import load_backend
+
+
+class Detector:
+
+    def __init__(self, weights=None, data='data/coco128.yaml', imgsz=640,
+                 conf_thres=0.25, iou_thres=0.45, max_det=1000, device='', backend='pytorch', threads=0):
+        self.device = select_device(device)
+        self.backend = backend
+        self.model = load_backend(backend, weights, data=data, device=self.device, threads=threads)
+        self.stride = self.model.stride
+        self.imgsz = check_img_size(imgsz, s=self.stride)
+        self.conf_thres = conf_thres
+        self.iou_thres = iou_thres
+        self.max_det = max_det
+
+        names = self.model.names
+        self.names = names if isinstance(names, dict) else dict(enumerate(names))
+        self.class_ids = {name: i for i, name in self.names.items()}
+        logger.info(f'Loaded {backend} model on {self.device}, inference size {self.imgsz}')
+
+    def warmup(self, batch_size=1):
+        """
+        Runs the model on a blank batch, so the one-time costs of the first forward pass (memory
+        allocation, kernel selection, TorchScript optimization passes) are paid before real traffic
+        """
+        blank = np.zeros((self.imgsz, self.imgsz, 3), dtype=np.uint8)
+        for size in sorted({1, batch_size}):
+            self.predict_batch([blank] * size)
+
+    def preprocess(self, image):
+        """
+        Letterboxes a BGR image (as returned by cv2) into the model's CHW RGB layout.
+        A fixed square size is used so images can later be stacked into one batch.
+        """
+        im = letterbox(image, self.imgsz, stride=self.stride, auto=False)[0]
+        im = im.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
+        return np.ascontiguousarray(im)
+
+    def predict(self, image):
+        """
+        Runs the model on a single BGR image.
+        :return: list of detections, one dict per object with normalized `cx, cy, width, height`
+                 (the same fields the yolov5 labels files used to hold) plus the class name and confidence
+        """
+        return self.predict_batch([image])[0]
+
+    @torch.no_grad()
+    def predict_batch(self, images):
+        """
+        Runs the model once on a batch of BGR images stacked into a single tensor.
+        :return: list with the detections of every image, in the same order as `images`
+        """
+        im = torch.from_numpy(np.stack([self.preprocess(image) for image in images])).to(self.device)
+        im = im.half() if self.model.fp16 else im.float()
+        im /= 255
+
+        pred = self.model(im)
+        dets = non_max_suppression(pred, self.conf_thres, self.iou_thres, max_det=self.max_det)
+        return [self.to_labels(det, im.shape[2:], image.shape) for det, image in zip(dets, images)]
+
+    def to_labels(self, det, input_shape, original_shape):
+        """Maps the NMS output of one image back to the original image coordinates."""
+        h, w = original_shape[:2]
+        det[:, :4] = scale_boxes(input_shape, det[:, :4], original_shape).round()
+
+        labels = []
+        for x1, y1, x2, y2, conf, cls in det.tolist():
+            labels.append({
+                'class': self.names[int(cls)],
+                'cx': (x1 + x2) / 2 / w,
+                'cy': (y1 + y2) / 2 / h,
+                'width': (x2 - x1) / w,
+                'height': (y2 - y1) / h,
+                'confidence': round(conf, 4),
+            })
+        return labels
+
+    def annotate(self, image, labels):
+        """Draws the detected boxes and class names on a copy of the BGR image."""
+        h, w = image.shape[:2]
+        annotator = Annotator(image.copy(), line_width=3, example=str(self.names))
+        for label in labels:
+            x1 = (label['cx'] - label['width'] / 2) * w
+            y1 = (label['cy'] - label['height'] / 2) * h
+            x2 = (label['cx'] + label['width'] / 2) * w
+            y2 = (label['cy'] + label['height'] / 2) * h
+            class_id = self.class_ids.get(label['class'], 0)
+            annotator.box_label((x1, y1, x2, y2), f"{label['class']} {label['confidence']:.2f}", color=colors(class_id, True))
+        return annotator.result()
@@ -0,0 +1,48 @@
+"""
+Admin HTTP server of the yolo5 worker, on METRICS_PORT:
+
+    /metrics    Prometheus metrics
+    /healthz    liveness, 200 as long as the process serves requests
+    /readyz     readiness, 200 only once the model is loaded and warmed up and the worker polls SQS
+"""
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '8081'))
+
+ready = threading.Event()
+
+
+class AdminHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self._reply(200, generate_latest(), CONTENT_TYPE_LATEST)
+        elif self.path == '/healthz':
+            self._reply(200, b'ok')
+        elif self.path == '/readyz':
+            if ready.is_set():
+                self._reply(200, b'ready')
+            else:
+                self._reply(503, b'starting')
+        else:
+            self._reply(404, b'not found')
+
+    def _reply(self, status, body, content_type='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Probes and scrapes hit these routes every few seconds, keep them out of the logs
+        pass
+
+
+def start_admin_server():
+    server = ThreadingHTTPServer(('0.0.0.0', METRICS_PORT), AdminHandler)
+    threading.Thread(target=server.serve_forever, name='admin-server', daemon=True).start()
+    return server
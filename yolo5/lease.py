@@ -0,0 +1,154 @@
+"""
+Visibility leases of the SQS messages the worker is processing.
+
+A message is received with a short visibility timeout, and its lease is extended by a heartbeat for
+as long as its job is in the pipeline, so a slow inference, upload or MongoDB write doesn't make the
+message visible to the other replicas, which would predict the same image again. When the worker
+dies, the heartbeats stop and the message is redelivered after one visibility timeout, instead of
+after a long timeout sized for the slowest job.
+"""
+import threading
+import time
+from loguru import logger
+from metrics import LEASES_IN_FLIGHT, LEASE_EXTENSIONS, LEASES_LOST, MESSAGES_DELETED
+
+# ChangeMessageVisibilityBatch and DeleteMessageBatch take at most 10 entries
+SQS_BATCH_SIZE = 10
+
+
+class LeaseManager:
+    """
+    Every `heartbeat_interval` seconds, extends the visibility timeout of all the in-flight messages
+    to `visibility_timeout` seconds from now. A message held for longer than `max_lease` seconds is
+    given up, so a job stuck in the pipeline is eventually redelivered (or moved to the dead-letter queue).
+    """
+
+    def __init__(self, sqs_client, queue_url, visibility_timeout=60, heartbeat_interval=20, max_lease=900):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.visibility_timeout = visibility_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.max_lease = max_lease
+        # receipt handle -> (prediction id, time the message was received)
+        self.leases = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name='lease-heartbeat', daemon=True)
+        LEASES_IN_FLIGHT.set_function(lambda: len(self.leases))
+
+    def start(self):
+        self.thread.start()
+
+    def acquire(self, job):
+        with self.lock:
+            self.leases[job['receipt_handle']] = (job['prediction_id'], time.time())
+
+    def release(self, job):
+        """Stops extending the lease of a job, once its message is deleted or the job was dropped"""
+        with self.lock:
+            self.leases.pop(job['receipt_handle'], None)
+
+    def wait_released(self, timeout):
+        """
+        Waits for all the leases to be released, as the worker shuts down
+        :return: the number of messages still held after `timeout` seconds, SQS redelivers them
+        """
+        deadline = time.monotonic() + timeout
+        while self.leases and time.monotonic() < deadline:
+            time.sleep(0.1)
+        return len(self.leases)
+
+    def _run(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            try:
+                self.heartbeat()
+            except Exception as e:
+                logger.exception(f'Lease heartbeat failed: {e}')
+
+    def heartbeat(self):
+        now = time.time()
+        with self.lock:
+            expired = [handle for handle, (_, received) in self.leases.items() if now - received > self.max_lease]
+            for handle in expired:
+                prediction_id, _ = self.leases.pop(handle)
+                LEASES_LOST.labels('max_lease').inc()
+                logger.warning(f'prediction: {prediction_id}. in flight for over {self.max_lease}s, giving up its lease')
+            handles = list(self.leases)
+
+        for i in range(0, len(handles), SQS_BATCH_SIZE):
+            entries = [{'Id': str(n), 'ReceiptHandle': handle, 'VisibilityTimeout': self.visibility_timeout}
+                       for n, handle in enumerate(handles[i:i + SQS_BATCH_SIZE])]
+            response = self.sqs_client.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=entries)
+            LEASE_EXTENSIONS.inc(len(response.get('Successful', [])))
+
+            # Usually a message that was deleted since the snapshot, or whose receipt handle expired
+            for failure in response.get('Failed', []):
+                handle = entries[int(failure['Id'])]['ReceiptHandle']
+                with self.lock:
+                    lease = self.leases.pop(handle, None)
+                if lease:
+                    LEASES_LOST.labels('extend_failed').inc()
+                    logger.warning(f'prediction: {lease[0]}. could not extend its lease: {failure.get("Message")}')
+
+
+class MessageDeleter:
+    """
+    Deletes the messages of finished jobs with DeleteMessageBatch, once SQS_BATCH_SIZE are buffered
+    or the oldest one has waited `max_delay` seconds, instead of one DeleteMessage call per message.
+    The lease of a message is released once its delete was attempted.
+    """
+
+    def __init__(self, sqs_client, queue_url, leases, max_delay=0.2):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.leases = leases
+        self.max_delay = max_delay
+        self.buffer = []
+        self.oldest = None
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.thread = threading.Thread(target=self._run, name='sqs-deleter', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def delete(self, job):
+        with self.lock:
+            if not self.buffer:
+                self.oldest = time.time()
+            self.buffer.append(job)
+            if len(self.buffer) >= SQS_BATCH_SIZE or len(self.buffer) == 1:
+                self.not_empty.notify()
+
+    def _take_batch(self):
+        with self.lock:
+            while True:
+                if self.buffer:
+                    wait = self.oldest + self.max_delay - time.time()
+                    if len(self.buffer) >= SQS_BATCH_SIZE or wait <= 0:
+                        batch, self.buffer = self.buffer[:SQS_BATCH_SIZE], self.buffer[SQS_BATCH_SIZE:]
+                        self.oldest = time.time()
+                        return batch
+                    self.not_empty.wait(timeout=wait)
+                else:
+                    self.not_empty.wait()
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            try:
+                self.flush(batch)
+            except Exception as e:
+                # The messages become visible again and are redelivered, their stored predictions are reused
+                MESSAGES_DELETED.labels('failed').inc(len(batch))
+                logger.exception(f'Error deleting {len(batch)} messages: {e}')
+            for job in batch:
+                self.leases.release(job)
+
+    def flush(self, batch):
+        entries = [{'Id': str(n), 'ReceiptHandle': job['receipt_handle']} for n, job in enumerate(batch)]
+        response = self.sqs_client.delete_message_batch(QueueUrl=self.queue_url, Entries=entries)
+        MESSAGES_DELETED.labels('deleted').inc(len(response.get('Successful', [])))
+        for failure in response.get('Failed', []):
+            MESSAGES_DELETED.labels('failed').inc()
+            logger.error(f'prediction: {batch[int(failure["Id"])]["prediction_id"]}. could not delete its message: {failure.get("Message")}')
@@ -0,0 +1,53 @@
+"""
+Prometheus metrics of the yolo5 worker, served by the admin server (health.py) at /metrics.
+"""
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from cache import prediction_cache
+from workspace import get_workspace
+
+# Latency buckets from a few milliseconds (Mongo, S3 on a warm connection) up to SQS backlogs of minutes
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+STAGE_SECONDS = Histogram('yolo5_stage_seconds', 'Time a pipeline stage spent on one job (or one batch)', ['stage'], buckets=LATENCY_BUCKETS)
+STAGE_FAILURES = Counter('yolo5_stage_failures_total', 'Jobs dropped because a pipeline stage failed', ['stage'])
+STAGE_QUEUE_DEPTH = Gauge('yolo5_stage_queue_depth', 'Jobs waiting in front of a pipeline stage', ['stage'])
+
+QUEUE_LAG_SECONDS = Histogram('yolo5_sqs_queue_lag_seconds', 'Time between polybot enqueuing a job and the worker receiving it', buckets=LATENCY_BUCKETS)
+S3_SECONDS = Histogram('yolo5_s3_seconds', 'S3 request latency', ['operation'], buckets=LATENCY_BUCKETS)
+MODEL_LOAD_SECONDS = Gauge('yolo5_model_load_seconds', 'Time it took to load the model at startup')
+WARMUP_SECONDS = Gauge('yolo5_warmup_seconds', 'Time the warm-up inference took at startup')
+INFERENCE_SECONDS = Histogram('yolo5_inference_seconds', 'Model forward pass and NMS latency of one batch', buckets=LATENCY_BUCKETS)
+INFERENCE_BATCH_SIZE = Histogram('yolo5_inference_batch_size', 'Number of images per inference batch', buckets=(1, 2, 4, 8, 16, 32))
+MONGO_INSERT_SECONDS = Histogram('yolo5_mongo_insert_seconds', 'Latency of one bulk insert of prediction summaries', buckets=LATENCY_BUCKETS)
+CALLBACK_SECONDS = Histogram('yolo5_callback_seconds', 'Latency of the /results callback to polybot', buckets=LATENCY_BUCKETS)
+PREDICTIONS = Counter('yolo5_predictions_total', 'Finished predictions', ['source'])
+LEASES_IN_FLIGHT = Gauge('yolo5_leases_in_flight', 'SQS messages the worker holds a visibility lease on')
+LEASE_EXTENSIONS = Counter('yolo5_lease_extensions_total', 'Visibility timeout extensions of in-flight SQS messages')
+LEASES_LOST = Counter('yolo5_leases_lost_total', 'In-flight SQS messages whose lease was given up', ['reason'])
+MESSAGES_DELETED = Counter('yolo5_sqs_messages_deleted_total', 'Messages of finished jobs deleted from SQS in batches', ['result'])
+RECEIVE_FAILURES = Counter('yolo5_receive_failures_total', 'Failed SQS receive_message calls and unparsable messages', ['reason'])
+
+
+class PredictionCacheCollector:
+    """Exports the hit/miss counters the prediction cache keeps by itself"""
+
+    def collect(self):
+        yield CounterMetricFamily('yolo5_prediction_cache_hits', 'Prediction cache hits', value=prediction_cache.hits)
+        yield CounterMetricFamily('yolo5_prediction_cache_misses', 'Prediction cache misses', value=prediction_cache.misses)
+
+
+class WorkspaceCollector:
+    """Exports the disk usage of the scratch space (see workspace.py)"""
+
+    def collect(self):
+        workspace = get_workspace()
+        size, files = workspace.usage()
+        yield GaugeMetricFamily('yolo5_workspace_bytes', 'Bytes used by the workspace artifacts', value=size)
+        yield GaugeMetricFamily('yolo5_workspace_files', 'Number of workspace artifacts', value=files)
+        yield CounterMetricFamily('yolo5_workspace_evictions', 'Workspace artifacts evicted to stay within budget', value=workspace.evictions)
+
+
+REGISTRY.register(PredictionCacheCollector())
+REGISTRY.register(WorkspaceCollector())
+
@@ -0,0 +1,16 @@
+"""
+One-off migration of `polybot-info.prediction_images` to the indexes of store.py.
+
+Workers that inserted their summaries (before the upserts) stored a redelivered prediction more
+than once, and the unique prediction_id index can't be built on those duplicates. Run it once,
+from the yolo5 image, before or after rolling out the workers:
+
+    kubectl exec deploy/yolo5-deployment -- python3 migrate.py
+"""
+from loguru import logger
+from store import remove_duplicate_predictions, ensure_indexes
+
+if __name__ == '__main__':
+    deleted = remove_duplicate_predictions()
+    logger.info(f'Removed {deleted} duplicate prediction documents')
+    ensure_indexes()
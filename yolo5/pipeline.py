@@ -0,0 +1,112 @@
+"""
+Staged processing pipeline for the yolo5 worker.
+
+Every stage owns a bounded input queue and a set of worker threads. A stage function takes a job
+(a dict) and returns the job to hand over to the next stage, or None when the job should go no
+further. Since the queues are bounded, a slow stage blocks the stages before it instead of
+letting jobs pile up in memory. A failing job is logged and handed to `on_failure`, the stage
+itself keeps running.
+"""
+import queue
+import threading
+import time
+from loguru import logger
+from metrics import STAGE_SECONDS, STAGE_FAILURES, STAGE_QUEUE_DEPTH
+
+
+class Stage:
+
+    def __init__(self, name, func, concurrency=1, maxsize=16, next_stage=None, on_failure=None):
+        self.name = name
+        self.func = func
+        self.concurrency = concurrency
+        self.next_stage = next_stage
+        self.on_failure = on_failure
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.threads = []
+        STAGE_QUEUE_DEPTH.labels(name).set_function(self.queue.qsize)
+
+    def put(self, job):
+        """Blocks while the stage's input queue is full."""
+        self.queue.put(job)
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def start(self):
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self._run, name=f'{self.name}-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                with STAGE_SECONDS.labels(self.name).time():
+                    result = self.func(job)
+            except Exception as e:
+                # The SQS message of a failed job is not deleted, it will be received again after the visibility timeout
+                STAGE_FAILURES.labels(self.name).inc()
+                logger.exception(f'prediction: {job.get("prediction_id")}. {self.name} stage failed: {e}')
+                self._failed([job])
+                continue
+            finally:
+                self.queue.task_done()
+
+            if result is not None and self.next_stage is not None:
+                self.next_stage.put(result)
+
+    def _failed(self, jobs):
+        if self.on_failure is None:
+            return
+        for job in jobs:
+            try:
+                self.on_failure(job)
+            except Exception as e:
+                logger.exception(f'prediction: {job.get("prediction_id")}. {self.name} failure handler failed: {e}')
+
+
+class BatchStage(Stage):
+    """
+    A stage that runs its function on micro-batches: it waits for a first job, then keeps collecting
+    jobs until `max_batch_size` are queued or `max_wait` seconds have passed.
+    The function takes a list of jobs and returns the list of jobs to hand over to the next stage.
+    """
+
+    def __init__(self, name, func, max_batch_size=8, max_wait=0.05, maxsize=16, next_stage=None, on_failure=None):
+        super().__init__(name, func, concurrency=1, maxsize=maxsize, next_stage=next_stage, on_failure=on_failure)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                with STAGE_SECONDS.labels(self.name).time():
+                    results = self.func(batch)
+            except Exception as e:
+                STAGE_FAILURES.labels(self.name).inc(len(batch))
+                logger.exception(f'{self.name} stage failed on a batch of {len(batch)}: {e}')
+                self._failed(batch)
+                continue
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+            if self.next_stage is not None:
+                for result in results:
+                    self.next_stage.put(result)
@@ -0,0 +1,154 @@
+"""
+MongoDB side of the yolo5 worker: indexes of `polybot-info.prediction_images` and a write buffer
+that stores prediction summaries in bulk instead of one insert_one per prediction.
+
+Summaries are upserted by prediction_id (the SQS MessageId), so a redelivered message that is
+processed again never creates a second document.
+"""
+import threading
+import time
+from loguru import logger
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+from clients import get_mongo_client
+from cache import prediction_cache
+from metrics import MONGO_INSERT_SECONDS, STAGE_FAILURES
+
+# Mongo error code of a duplicate key, raised when two upserts of the same prediction race
+DUPLICATE_KEY_ERROR = 11000
+
+
+def get_predictions_collection():
+    # Select the database (polybot-info) and collection (prediction_images)
+    return get_mongo_client()['polybot-info']['prediction_images']
+
+
+def find_stored_prediction(prediction_id):
+    """:return: the stored summary of a prediction, or None when it was not stored yet"""
+    return get_predictions_collection().find_one(
+        {'prediction_id': prediction_id}, {'_id': 0, 'labels': 1, 'predicted_img_path': 1})
+
+
+def ensure_indexes():
+    """
+    Creates the indexes the polybot read paths rely on, it's a no-op when they already exist.
+    The unique prediction_id index comes last: it can't be built while the collection holds
+    duplicates (see remove_duplicate_predictions), the other indexes are in place by then.
+    """
+    collection = get_predictions_collection()
+    # the history of a chat is read newest first
+    collection.create_index([('chat_id', ASCENDING), ('time', DESCENDING)], name='chat_id_time')
+    # the photos of an album, only read back when polybot gets an album callback without its summary
+    collection.create_index([('album_id', ASCENDING)], sparse=True, name='album_id')
+    # cached results expire after PREDICTION_CACHE_TTL
+    prediction_cache.ensure_indexes()
+    # /results looks predictions up by id
+    collection.create_index([('prediction_id', ASCENDING)], unique=True, name='prediction_id_unique')
+    logger.info('MongoDB indexes are in place')
+
+
+def remove_duplicate_predictions():
+    """
+    One-off migration for the prediction_id_unique index: before summaries were upserted, every
+    redelivered message inserted its prediction again. Keeps the first stored document of each prediction.
+    :return: the number of deleted documents
+    """
+    collection = get_predictions_collection()
+    duplicates = collection.aggregate([
+        {'$sort': {'_id': 1}},
+        {'$group': {'_id': '$prediction_id', 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+    ], allowDiskUse=True)
+    deleted = 0
+    for duplicate in duplicates:
+        deleted += collection.delete_many({'_id': {'$in': duplicate['ids'][1:]}}).deleted_count
+    return deleted
+
+
+class PredictionWriter:
+    """
+    Buffers prediction summaries and writes them with a single unordered bulk write, once
+    `max_size` summaries are buffered or the oldest one has waited `max_delay` seconds.
+    After every flush, `on_flush(job)` is called for each job whose summary is stored, and
+    `on_failure(job)` for each job whose summary could not be written.
+    """
+
+    def __init__(self, on_flush, max_size=50, max_delay=0.2, on_failure=None):
+        self.on_flush = on_flush
+        self.on_failure = on_failure
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.buffer = []
+        self.oldest = None
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.thread = threading.Thread(target=self._run, name='mongo-writer', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def add(self, summary, job):
+        with self.lock:
+            if not self.buffer:
+                self.oldest = time.time()
+            self.buffer.append((summary, job))
+            if len(self.buffer) >= self.max_size or len(self.buffer) == 1:
+                self.not_empty.notify()
+
+    def _take_batch(self):
+        with self.lock:
+            while True:
+                if self.buffer:
+                    wait = self.oldest + self.max_delay - time.time()
+                    if len(self.buffer) >= self.max_size or wait <= 0:
+                        batch, self.buffer = self.buffer, []
+                        return batch
+                    self.not_empty.wait(timeout=wait)
+                else:
+                    self.not_empty.wait()
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            try:
+                stored = self.flush(batch)
+            except Exception as e:
+                # The SQS messages of these jobs are kept, the predictions will be retried after the visibility timeout
+                STAGE_FAILURES.labels('mongo').inc(len(batch))
+                logger.exception(f'Error inserting {len(batch)} prediction summaries to MongoDB: {e}')
+                stored = []
+
+            stored_ids = set(map(id, stored))
+            for _, job in batch:
+                callback = self.on_flush if id(job) in stored_ids else self.on_failure
+                if callback is None:
+                    continue
+                try:
+                    callback(job)
+                except Exception as e:
+                    logger.exception(f'prediction: {job["prediction_id"]}. post-insert step failed: {e}')
+
+    def flush(self, batch):
+        """
+        Writes one batch of summaries
+        :return: the jobs whose summary is stored (duplicates of an already stored prediction included)
+        """
+        # $setOnInsert keeps the first stored summary of a prediction, writing it again is a no-op
+        requests = [
+            UpdateOne({'prediction_id': summary['prediction_id']},
+                      {'$setOnInsert': {k: v for k, v in summary.items() if k != 'prediction_id'}}, upsert=True)
+            for summary, _ in batch
+        ]
+        failed = set()
+        try:
+            with MONGO_INSERT_SECONDS.time():
+                get_predictions_collection().bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                if error['code'] != DUPLICATE_KEY_ERROR:
+                    failed.add(error['index'])
+                    STAGE_FAILURES.labels('mongo').inc()
+                    logger.error(f'Error inserting prediction summary {batch[error["index"]][1]["prediction_id"]}: {error["errmsg"]}')
+
+        logger.info(f'{len(batch) - len(failed)} prediction summaries stored successfully')
+        return [job for i, (_, job) in enumerate(batch) if i not in failed]
@@ -0,0 +1,15 @@
+from albums import AlbumTracker
+
+
+def album_job(album_id, index, size):
+    return {'prediction_id': f'{album_id}-{index}', 'album': {'id': album_id, 'index': index, 'size': size}}
+
+
+def test_album_is_complete_once_every_photo_is_stored():
+    tracker = AlbumTracker()
+    assert tracker.add(album_job('a', 2, 3)) is None
+    assert tracker.add(album_job('a', 0, 3)) is None
+    parts = tracker.add(album_job('a', 1, 3))
+
+    assert [part['prediction_id'] for part in parts] == ['a-0', 'a-1', 'a-2']
+    assert tracker.albums == {}
@@ -0,0 +1,93 @@
+import threading
+import time
+from lease import LeaseManager, MessageDeleter
+
+
+class FakeSQS:
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.calls = []
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        self.calls.append(Entries)
+        return {
+            'Successful': [{'Id': e['Id']} for e in Entries if e['ReceiptHandle'] not in self.failing],
+            'Failed': [{'Id': e['Id'], 'Message': 'receipt handle expired'} for e in Entries if e['ReceiptHandle'] in self.failing],
+        }
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        return self.change_message_visibility_batch(QueueUrl, Entries)
+
+
+def job(n):
+    return {'receipt_handle': f'handle-{n}', 'prediction_id': f'p{n}'}
+
+
+def test_heartbeat_extends_all_leases_in_batches_of_ten():
+    sqs = FakeSQS()
+    leases = LeaseManager(sqs, 'queue', visibility_timeout=60)
+    for n in range(12):
+        leases.acquire(job(n))
+    leases.heartbeat()
+
+    assert [len(entries) for entries in sqs.calls] == [10, 2]
+    assert all(entry['VisibilityTimeout'] == 60 for entries in sqs.calls for entry in entries)
+    assert len(leases.leases) == 12
+
+
+def test_released_and_failed_leases_are_no_longer_extended():
+    sqs = FakeSQS(failing={'handle-1'})
+    leases = LeaseManager(sqs, 'queue')
+    for n in range(3):
+        leases.acquire(job(n))
+    leases.release(job(0))
+    leases.heartbeat()
+    leases.heartbeat()
+
+    assert [entry['ReceiptHandle'] for entry in sqs.calls[-1]] == ['handle-2']
+
+
+def test_lease_is_given_up_after_max_lease():
+    sqs = FakeSQS()
+    leases = LeaseManager(sqs, 'queue', max_lease=0.01)
+    leases.acquire(job(0))
+    time.sleep(0.02)
+    leases.heartbeat()
+
+    assert sqs.calls == []
+    assert leases.leases == {}
+
+
+
+def test_deleter_deletes_in_batches_of_ten_and_releases_the_leases():
+    sqs = FakeSQS(failing={'handle-3'})
+    leases = LeaseManager(sqs, 'queue')
+    jobs = [job(n) for n in range(12)]
+    for j in jobs:
+        leases.acquire(j)
+
+    deleter = MessageDeleter(sqs, 'queue', leases, max_delay=0.05)
+    released = threading.Semaphore(0)
+    release = leases.release
+    leases.release = lambda j: (release(j), released.release())
+    deleter.start()
+    for j in jobs:
+        deleter.delete(j)
+    for _ in jobs:
+        assert released.acquire(timeout=5)
+
+    assert [len(entries) for entries in sqs.calls] == [10, 2]
+    # A failed delete releases its lease too, the message is redelivered
+    assert leases.leases == {}
+
+
+def test_wait_released_returns_the_messages_still_held():
+    leases = LeaseManager(FakeSQS(), 'queue')
+    leases.acquire(job(0))
+    leases.acquire(job(1))
+    threading.Timer(0.05, leases.release, [job(0)]).start()
+
+    assert leases.wait_released(timeout=0.3) == 1
+    leases.release(job(1))
+    assert leases.wait_released(timeout=0.3) == 0
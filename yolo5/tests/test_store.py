@@ -0,0 +1,116 @@
+import threading
+import pytest
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+import store
+from store import PredictionWriter, DUPLICATE_KEY_ERROR, remove_duplicate_predictions
+
+
+class FakeCollection:
+
+    def __init__(self, error=None):
+        self.error = error
+        self.writes = []
+        self.documents = []
+
+    def aggregate(self, pipeline, allowDiskUse=False):
+        groups = {}
+        for document in sorted(self.documents, key=lambda document: document['_id']):
+            groups.setdefault(document['prediction_id'], []).append(document['_id'])
+        return [{'_id': prediction_id, 'ids': ids, 'count': len(ids)} for prediction_id, ids in groups.items() if len(ids) > 1]
+
+    def delete_many(self, query):
+        ids = set(query['_id']['$in'])
+        before = len(self.documents)
+        self.documents = [document for document in self.documents if document['_id'] not in ids]
+        return type('DeleteResult', (), {'deleted_count': before - len(self.documents)})()
+
+    def bulk_write(self, requests, ordered=True):
+        self.writes.append((requests, ordered))
+        if self.error:
+            raise self.error
+
+
+@pytest.fixture
+def collection(monkeypatch):
+    collection = FakeCollection()
+    monkeypatch.setattr(store, 'get_predictions_collection', lambda: collection)
+    return collection
+
+
+def batch_of(n):
+    return [({'prediction_id': f'p{i}', 'chat_id': '42', 'labels': []}, {'prediction_id': f'p{i}'}) for i in range(n)]
+
+
+def write_error(index, code):
+    return {'index': index, 'code': code, 'errmsg': f'error {code}'}
+
+
+def test_flush_upserts_the_summaries_in_one_unordered_bulk_write(collection):
+    batch = batch_of(3)
+    stored = PredictionWriter(on_flush=None).flush(batch)
+
+    assert stored == [job for _, job in batch]
+    (requests, ordered), = collection.writes
+    assert not ordered
+    assert requests[0] == UpdateOne({'prediction_id': 'p0'}, {'$setOnInsert': {'chat_id': '42', 'labels': []}}, upsert=True)
+
+
+def test_duplicate_key_counts_as_stored_other_errors_as_failed(collection):
+    collection.error = BulkWriteError({'writeErrors': [write_error(0, DUPLICATE_KEY_ERROR), write_error(1, 121)]})
+    batch = batch_of(3)
+    stored = PredictionWriter(on_flush=None).flush(batch)
+
+    assert [job['prediction_id'] for job in stored] == ['p0', 'p2']
+
+
+def run_writer(batch, **kwargs):
+    """Runs the writer thread on one batch and returns the prediction ids passed to on_flush and on_failure"""
+    flushed, failed = [], []
+    done = threading.Semaphore(0)
+
+    def record(calls):
+        def callback(job):
+            calls.append(job['prediction_id'])
+            done.release()
+        return callback
+
+    kwargs.setdefault('max_size', len(batch))
+    writer = PredictionWriter(record(flushed), on_failure=record(failed), **kwargs)
+    writer.start()
+    for summary, job in batch:
+        writer.add(summary, job)
+    for _ in batch:
+        assert done.acquire(timeout=5)
+    return flushed, failed
+
+
+def test_writer_notifies_stored_and_failed_jobs(collection):
+    collection.error = BulkWriteError({'writeErrors': [write_error(1, 121)]})
+    flushed, failed = run_writer(batch_of(3))
+
+    assert flushed == ['p0', 'p2']
+    assert failed == ['p1']
+
+
+def test_failed_bulk_write_fails_the_whole_batch(collection):
+    collection.error = ConnectionError('mongo is down')
+    flushed, failed = run_writer(batch_of(2))
+
+    assert flushed == []
+    assert failed == ['p0', 'p1']
+
+
+def test_writer_flushes_a_partial_batch_after_max_delay(collection):
+    flushed, failed = run_writer(batch_of(2), max_size=10, max_delay=0.05)
+
+    assert flushed == ['p0', 'p1']
+    assert len(collection.writes) == 1
+
+
+def test_remove_duplicate_predictions_keeps_the_first_document(collection):
+    collection.documents = [{'_id': 1, 'prediction_id': 'p0'}, {'_id': 2, 'prediction_id': 'p1'},
+                            {'_id': 3, 'prediction_id': 'p0'}, {'_id': 4, 'prediction_id': 'p0'}]
+
+    assert remove_duplicate_predictions() == 2
+    assert [document['_id'] for document in collection.documents] == [1, 2]
@@ -0,0 +1,119 @@
+"""
+Bounded scratch space on the local disk.
+
+The predictions themselves run in memory, the disk only holds artifacts kept for debugging (such as
+images that could not be decoded). They live under WORKSPACE_DIR, on tmpfs (/dev/shm) when it is
+available, and are evicted least recently used first once WORKSPACE_MAX_BYTES or WORKSPACE_MAX_FILES
+is exceeded, so a long-running pod never fills its disk.
+"""
+import contextlib
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from loguru import logger
+
+WORKSPACE_NAME = 'yolo5'
+WORKSPACE_DIR = os.environ.get('WORKSPACE_DIR')
+WORKSPACE_MAX_BYTES = int(os.environ.get('WORKSPACE_MAX_BYTES', str(32 * 1024 * 1024)))
+WORKSPACE_MAX_FILES = int(os.environ.get('WORKSPACE_MAX_FILES', '500'))
+
+
+def default_root():
+    # tmpfs keeps the artifacts off the node's disk, and they are gone with the pod anyway
+    base = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else tempfile.gettempdir()
+    return os.path.join(base, WORKSPACE_NAME)
+
+
+class Workspace:
+
+    def __init__(self, root, max_bytes=WORKSPACE_MAX_BYTES, max_files=WORKSPACE_MAX_FILES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        # artifact path -> size, least recently used first
+        self.artifacts = OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(root, exist_ok=True)
+        # Artifacts of a previous process (a restarted container keeps its emptyDir) count against the budget too
+        entries = []
+        for entry in os.scandir(root):
+            if entry.name.startswith('.tmp-'):
+                os.remove(entry.path)
+            elif entry.is_file():
+                entries.append(entry)
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            self.artifacts[entry.path] = entry.stat().st_size
+            self.bytes += entry.stat().st_size
+        with self.lock:
+            self._evict()
+        logger.info(f'Workspace {root}: {len(self.artifacts)} artifacts, {self.bytes} bytes')
+
+    def path(self, name):
+        # Names come from S3 keys and Telegram file paths, keep them flat and safe
+        return os.path.join(self.root, re.sub(r'[^\w.-]', '_', name))
+
+    def keep(self, name, data):
+        """
+        Stores an artifact, evicting the least recently used ones when over budget
+        :return: the artifact's path, or None when it could not be written (the workspace is best effort)
+        """
+        path = self.path(name)
+        # Written under a temporary name and renamed, so a reader never sees a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f'Could not write {name} to the workspace: {e}')
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            return None
+
+        with self.lock:
+            self.bytes += len(data) - self.artifacts.pop(path, 0)
+            self.artifacts[path] = len(data)
+            self._evict()
+        return path
+
+    def get(self, name):
+        """:return: the path of a kept artifact, marked as recently used, or None when it was evicted"""
+        path = self.path(name)
+        with self.lock:
+            if path not in self.artifacts:
+                return None
+            self.artifacts.move_to_end(path)
+        return path
+
+    def usage(self):
+        """:return: bytes and number of files used by the artifacts"""
+        with self.lock:
+            return self.bytes, len(self.artifacts)
+
+    def _evict(self):
+        while self.artifacts and (self.bytes > self.max_bytes or len(self.artifacts) > self.max_files):
+            path, size = self.artifacts.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+_workspace = None
+_lock = threading.Lock()
+
+
+def get_workspace():
+    global _workspace
+    if _workspace is None:
+        with _lock:
+            if _workspace is None:
+                _workspace = Workspace(WORKSPACE_DIR or default_root())
+    return _workspace